@@ -1,27 +1,33 @@
 # coding: utf-8
 
-import six
+import _thread
+import _weakref
+import io
 import sys
-import threading
+import types
 
-from six.moves import zip
-from itertools import starmap, chain
-from operator import attrgetter
+from contextvars import ContextVar
+from itertools import chain, islice, repeat
+from operator import attrgetter, itemgetter
+from time import perf_counter
 
 
 __version__ = "0.3.1"
 
-__all__ = ['make_repr']
+__all__ = ['make_repr', 'iter_repr', 'write_repr', 'format_many',
+           'format_bytes', 'lazy_repr', 'arepr', 'Memo',
+           'register_formatter', 'instrument', 'stop_instrumenting',
+           'timeouts']
 
 
-ON_PYTHON2 = sys.version_info.major == 2
+def loaded(module, name):
+    """Returns an attribute of the module if it was imported already,
+    otherwise ``None``.
 
-
-def force_unicode(value):
-    """If input string is binary, then decode from utf-8."""
-    if isinstance(value, six.binary_type):
-        return value.decode('utf-8')
-    return value
+    Values of types from a module can't exist before the module
+    is imported, so there is no need to import it to check types.
+    """
+    return getattr(sys.modules.get(module), name, None)
 
 
 def is_multiline(text):
@@ -59,6 +65,221 @@ def cut_head(lst):
     return lst[0], lst[1:]
 
 
+class Text(object):
+    """A leaf of the layout tree.
+
+    Text may contain line breaks, in this case all lines except
+    the first one will be aligned to the column where the
+    text starts.
+
+    ``hard`` tells if there are line breaks which can't be
+    avoided, for a text it is the same as ``multiline``.
+    """
+    __slots__ = ('text', 'width', 'multiline', 'hard')
+
+    def __init__(self, text):
+        self.text = text
+        self.width = len(text)
+        self.multiline = self.hard = u'\n' in text
+
+
+class Concat(object):
+    """Layout nodes which follow each other.
+
+    Each part starts right where the previous one ends.
+    """
+    __slots__ = ('parts', 'width', 'multiline', 'hard')
+
+    def __init__(self, *parts):
+        self.parts = parts
+        # nodes are made for each value, so a plain loop
+        # is used instead of generators for speed
+        width = 0
+        multiline = hard = False
+        for part in parts:
+            width += part.width
+            if part.multiline:
+                multiline = True
+                hard = hard or part.hard
+        self.width = width
+        self.multiline = multiline
+        self.hard = hard
+
+
+MAX_LENGTH = 20
+
+
+class Group(object):
+    """Items which are shown in a row or as a column.
+
+    All items are shown in a column, aligned to the column
+    where the group starts, if some of them are multiline,
+    or if their summary length is more than ``max_length``.
+
+    When output is rendered for the given line width, this
+    decision is made by :func:`render_fitted` instead.
+    ``width`` is the width of the group shown in a row.
+    """
+    __slots__ = ('items', 'delimiter', 'vertical', 'width', 'multiline',
+                 'hard')
+
+    def __init__(self, items, delimiter=u'', max_length=MAX_LENGTH):
+        self.items = items = list(items)
+        self.delimiter = delimiter
+
+        length = 0
+        have_multiline_items = hard = False
+        for item in items:
+            length += item.width
+            if item.multiline:
+                have_multiline_items = True
+                hard = hard or item.hard
+
+        self.vertical = have_multiline_items or length > max_length
+        self.width = length + max(len(items) - 1, 0) * (len(delimiter) + 1)
+        self.multiline = have_multiline_items or \
+            (self.vertical and len(items) > 1)
+        self.hard = hard
+
+
+def render_node(node, column, write, push):
+    """Renders one node of the layout tree.
+
+    Strings are written as is, other nodes either write their text
+    or push their parts to the stack. Returns a column where
+    the output ends.
+    """
+    cls = type(node)
+    if cls is str:
+        write(node)
+        newline = node.rfind(u'\n')
+        if newline == -1:
+            return column + len(node)
+        return len(node) - newline - 1
+
+    if cls is Text:
+        if node.multiline:
+            lines = node.text.split(u'\n')
+            newline = u'\n' + u' ' * column
+            write(newline.join(lines))
+            return column + len(lines[-1])
+        write(node.text)
+        return column + node.width
+
+    if cls is Concat:
+        for part in reversed(node.parts):
+            push(part)
+        return column
+
+    items = node.items
+    if items:
+        if node.vertical:
+            delimiter = node.delimiter + u'\n' + u' ' * column
+        else:
+            delimiter = node.delimiter + u' '
+
+        for item in reversed(items[1:]):
+            push(item)
+            push(delimiter)
+        push(items[0])
+
+    return column
+
+
+def render_fitted(item, column, write, push, width):
+    """Renders one node of the layout tree, fitting it into
+    the lines of the given ``width``.
+
+    ``item`` is a triple ``(node, flat, trail)``, where ``flat``
+    tells that node should be shown in one line, and ``trail`` is
+    a width of the text which follows the node on the same line.
+    Children are pushed to the stack as such triples too.
+
+    Group is shown in a row if it fits into the line together
+    with its trail, otherwise it's items are shown in a column and
+    each of them decides for itself. Widths of the nodes are known
+    in advance, so each decision takes a constant time, like
+    in pretty printers by Oppen and Wadler.
+    """
+    node, flat, trail = item
+
+    if isinstance(node, Concat):
+        # only texts following the part up to the next
+        # nested value are counted as it's trail
+        following = trail
+        for part in reversed(node.parts):
+            push((part, flat, following))
+            if isinstance(part, Text):
+                following += part.width
+            else:
+                following = 0
+        return column
+
+    if isinstance(node, Group):
+        items = node.items
+        if not items:
+            return column
+
+        if flat or (not node.hard and
+                    column + node.width + trail <= width):
+            delimiter = node.delimiter + u' '
+            flat = True
+        else:
+            delimiter = node.delimiter + u'\n' + u' ' * column
+
+        # the last item is followed by the group's own trail,
+        # others only by the delimiter
+        push((items[-1], flat, trail))
+        if len(items) > 1:
+            trail = len(node.delimiter)
+            push(delimiter)
+            for item in reversed(items[1:-1]):
+                push((item, flat, trail))
+                push(delimiter)
+            push((items[0], flat, trail))
+        return column
+
+    return render_node(node, column, write, push)
+
+
+def render(node, width=None):
+    """Renders layout tree into the unicode string.
+
+    Tree is walked only once and all paddings are added here,
+    so rendering cost is linear to the output's size, no matter
+    how deeply nodes are nested.
+
+    If ``width`` is given, groups are shown in a row when they fit
+    into lines of this width, see :func:`render_fitted`.
+    """
+    if type(node) is Text and not node.multiline:
+        # collapsed values are rendered already
+        return node.text
+
+    chunks = []
+    write = chunks.append
+    column = 0
+    # stack contains nodes and already prepared strings
+    # which are written as is
+    stack = [node]
+    pop = stack.pop
+    push = stack.append
+
+    if width is None:
+        while stack:
+            column = render_node(pop(), column, write, push)
+    else:
+        stack[0] = (node, False, 0)
+        while stack:
+            item = pop()
+            if isinstance(item, tuple):
+                column = render_fitted(item, column, write, push, width)
+            else:
+                column = render_node(item, column, write, push)
+
+    return u''.join(chunks)
+
+
 def serialize_text(out, text):
     """This method is used to append content of the `text`
     argument to the `out` argument.
@@ -69,16 +290,10 @@ def serialize_text(out, text):
 
     Concatenation result is appended to the `out` argument.
     """
-    padding = len(out)
-    # we need to add padding to all lines
-    # except the first one
-    add_padding = padding_adder(padding)
-    text = add_padding(text, ignore_first_line=True)
+    return render(Concat(Text(out), Text(text)))
 
-    return out + text
 
-
-def serialize_list(out, lst, delimiter=u'', max_length=20):
+def serialize_list(out, lst, delimiter=u'', max_length=MAX_LENGTH):
 
     """This method is used to serialize list of text
     pieces like ["some=u'Another'", "blah=124"]
@@ -88,93 +303,2546 @@ def serialize_list(out, lst, delimiter=u'', max_length=20):
 
     Concatenation result is appended to the `out` argument.
     """
+    items = map(Text, lst)
+    group = Group(items, delimiter=delimiter, max_length=max_length)
+    return render(Concat(Text(out), group))
+
+
+class Options(object):
+    """Settings of the formatting.
+
+    Limits:
+
+    * ``max_depth`` -- how many levels of nested containers and
+      objects are shown, deeper ones are replaced with ``...``;
+    * ``max_items`` -- how many items of each container are shown;
+    * ``max_string`` -- how many characters of each string are shown;
+    * ``max_chars`` -- after how many characters of values
+      the formatting stops;
+    * ``deadline_ms`` -- after how many milliseconds the formatting
+      stops. Time is checked between fields of objects and items
+      of containers, and a marker ``...<timeout>`` is shown
+      where the formatting stopped.
+
+    Limits which are ``None`` are not applied.
+
+    Other settings:
+
+    * ``memo`` -- a :class:`Memo` to reuse layouts of immutable values;
+    * ``references`` -- if true, objects with ``__repr__`` made by
+      ``make_repr`` are shown once, and other occurrences of them
+      are shown as references like ``<Vendor #3>``;
+    * ``dict_order`` -- how items of dicts are ordered: ``'repr'``
+      sorts them by representations of keys, this is the default,
+      ``'keys'`` sorts them by keys themselves, which is faster,
+      and ``'insertion'`` keeps them in the dict's order;
+    * ``consume_iterators`` -- if true, items of generators and other
+      iterators are shown. They can't be iterated again, so
+      by default they are shown with ``repr``;
+    * ``width`` -- width of lines, lists, dicts and objects which
+      fit into them are shown in a row. By default they are shown
+      in a column if their items are multiline or longer than
+      20 characters. Width is taken from the options of the
+      formatting call or of the formatted object itself,
+      nested objects can't change it;
+    * ``table`` -- if true, lists of objects of the same class with
+      ``__repr__`` made by ``make_repr`` are shown as tables, with
+      a header of field names and a row of values for each object.
+    """
+    __slots__ = ('max_depth', 'max_items', 'max_string', 'max_chars',
+                 'deadline_ms', 'memo', 'references', 'dict_order', 'consume_iterators',
+                 'width', 'table', 'limited')
+
+    limits = ('max_depth', 'max_items', 'max_string', 'max_chars',
+              'deadline_ms')
+    names = limits + ('memo', 'references', 'dict_order',
+                      'consume_iterators', 'width', 'table')
+
+    dict_orders = (None, 'repr', 'keys', 'insertion')
+
+    def __init__(self, max_depth=None, max_items=None,
+                 max_string=None, max_chars=None, deadline_ms=None,
+                 memo=None,
+                 references=None, dict_order=None,
+                 consume_iterators=None, width=None, table=None):
+        if dict_order not in self.dict_orders:
+            raise ValueError(
+                'dict_order should be one of {0}, not {1!r}'.format(
+                    ', '.join(repr(order)
+                              for order in self.dict_orders[1:]),
+                    dict_order))
+
+        self.max_depth = max_depth
+        self.max_items = max_items
+        self.max_string = max_string
+        self.max_chars = max_chars
+        self.deadline_ms = deadline_ms
+        self.memo = memo
+        self.references = references
+        self.dict_order = dict_order
+        self.consume_iterators = consume_iterators
+        self.width = width
+        self.table = table
+        self.limited = any(getattr(self, name) is not None
+                           for name in self.limits)
+
+    def merge(self, other):
+        """Returns options where values of ``other``
+        override values of ``self``."""
+        values = dict((name, getattr(self, name))
+                      for name in self.names)
+        values.update((name, getattr(other, name))
+                      for name in other.names
+                      if getattr(other, name) is not None)
+        return Options(**values)
+
+
+DEFAULT_OPTIONS = Options()
+
+
+class Counter(object):
+    """Thread-safe counter."""
+
+    def __init__(self):
+        self.value = 0
+        self.lock = _thread.allocate_lock()
+
+    def increment(self):
+        with self.lock:
+            self.value += 1
+
+    def reset(self):
+        with self.lock:
+            self.value = 0
+
+
+# how many formatting calls were stopped by deadlines
+timeouts = Counter()
+
+
+class Memo(object):
+    """Bounded LRU cache for layouts of immutable values.
+
+    Objects often contain the same immutable values, like enum members,
+    dates or tuples of settings. With a memo they are formatted once
+    and then their layouts are reused::
+
+      memo = Memo(maxsize=10000)
+
+      class Order(object):
+          __repr__ = make_repr(memo=memo)
+
+    Least recently used layouts are evicted when there are
+    more than ``maxsize`` of them.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # dicts keep order of insertion
+        self.items = {}
+        self.lock = _thread.allocate_lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        with self.lock:
+            try:
+                node = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            # most recently used items are at the end
+            self.items[key] = node
+            self.hits += 1
+            return node
+
+    def put(self, key, node):
+        with self.lock:
+            self.items[key] = node
+            if len(self.items) > self.maxsize:
+                del self.items[next(iter(self.items))]
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def stats(self):
+        """Returns a dict with size of the memo and
+        numbers of hits, misses and evictions."""
+        return dict(size=len(self.items),
+                    maxsize=self.maxsize,
+                    hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions)
+
+
+class ReprCache(object):
+    """Rendered representations of objects, made by
+    ``make_repr(..., cache=True)``.
+
+    A representation is kept until one of the object's ``fields``
+    is assigned or deleted, or any attribute if ``fields`` is ``None``.
+    To notice this, ``__setattr__`` and ``__delattr__`` of classes
+    of the objects are wrapped. Objects are referenced weakly,
+    so the cache does not keep them alive.
+
+    Objects which can't be referenced weakly and objects of classes
+    which can't be changed are not cached.
+    """
+
+    def __init__(self, fields=None):
+        self.fields = fields
+        self.hits = 0
+        self.misses = 0
+        # object's id -> (weak reference, representation or None)
+        self.items = {}
+        self.uncached = set()
+        self.lock = _thread.allocate_lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, obj):
+        entry = self.items.get(id(obj))
+        if entry is not None and entry[1] is not None \
+           and entry[0]() is obj:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def reserve(self, obj):
+        """Starts caching of the object's representation.
+
+        Returns an entry to pass to :meth:`put`, or ``None``
+        if the object can't be cached.
+        """
+        cls = type(obj)
+        if cls in self.uncached:
+            return None
+
+        key = id(obj)
+
+        def drop(reference):
+            with self.lock:
+                entry = self.items.get(key)
+                if entry is not None and entry[0] is reference:
+                    del self.items[key]
+
+        # classes are changed only if their objects can be cached
+        try:
+            entry = (_weakref.ref(obj, drop), None)
+        except TypeError:
+            self.uncached.add(cls)
+            return None
+
+        if not self.track(cls):
+            return None
+
+        with self.lock:
+            self.items[key] = entry
+        return entry
+
+    def put(self, obj, entry, text):
+        """Keeps the representation, unless the object
+        was changed since :meth:`reserve`."""
+        key = id(obj)
+        with self.lock:
+            if self.items.get(key) is entry:
+                self.items[key] = (entry[0], text)
+
+    def forget(self, obj, name=None):
+        if (self.fields is None or name in self.fields) \
+           and id(obj) in self.items:
+            with self.lock:
+                self.items.pop(id(obj), None)
+
+    def track(self, cls):
+        """Wraps ``__setattr__`` and ``__delattr__`` of the class
+        unless they are wrapped already."""
+        if getattr(cls.__setattr__, 'magic_repr_cache', None) is self:
+            return True
+
+        setter = cls.__setattr__
+        deleter = cls.__delattr__
+        forget = self.forget
+
+        def __setattr__(obj, name, value):
+            setter(obj, name, value)
+            forget(obj, name)
+
+        def __delattr__(obj, name):
+            deleter(obj, name)
+            forget(obj, name)
+
+        __setattr__.magic_repr_cache = self
+        __delattr__.magic_repr_cache = self
+
+        try:
+            cls.__setattr__ = __setattr__
+            cls.__delattr__ = __delattr__
+        except (TypeError, AttributeError):
+            # builtin and extension types can't be changed
+            self.uncached.add(cls)
+            return False
+        return True
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def stats(self):
+        """Returns a dict with size of the cache and
+        numbers of hits and misses."""
+        return dict(size=len(self.items),
+                    hits=self.hits,
+                    misses=self.misses)
+
+
+# equal values of these types always have the same representation
+PLAIN_MEMO_TYPES = {int, bool, type(None)}
+
+
+def memo_key(context, value):
+    """Returns a key for the :class:`Memo`, or ``None``
+    if value's layout can't be memoized.
+
+    Key includes value's type, so 1, 1.0 and True have different keys,
+    and everything else the representation depends on, like a sign
+    of zero floats or a time zone.
+    """
+    cls = type(value)
+
+    if cls in PLAIN_MEMO_TYPES:
+        return cls, value
+
+    if cls is str or cls is bytes:
+        return cls, value, context.options.max_string
+
+    if cls is float:
+        from math import copysign
+        return cls, value, copysign(1.0, value)
+
+    datetime = sys.modules.get('datetime')
+    if datetime is not None:
+        if cls is datetime.date or cls is datetime.timedelta:
+            return cls, value
+
+        if cls is datetime.datetime or cls is datetime.time:
+            # time zones with equal offsets can have different
+            # representations, but the value keeps it's time zone alive,
+            # so it's id can be used in the key
+            return cls, value, id(value.tzinfo), value.fold
+
+    if cls is tuple:
+        # layouts of tuples depend on limits
+        if context.limited:
+            return None
+
+        keys = tuple(memo_key(context, item) for item in value)
+        if any(key is None for key in keys):
+            return None
+        # tuples are collapsed into texts only without a width
+        return cls, keys, context.width is None
+
+    enum = loaded('enum', 'Enum')
+    if enum is not None and isinstance(value, enum):
+        return cls, value
+
+    return None
+
+
+class Context(object):
+    """State of the formatting call: it's options and spent budgets.
+
+    ``limited`` tells if budgets should be checked at all.
+    ``processed`` are ids of values which are being laid out,
+    they are used to break recursion.
+    ``labels`` are numbers of objects which were shown already,
+    they are used when references are turned on.
+    ``deadline`` is a time when the formatting should stop,
+    it is the earliest of deadlines of all options which were applied.
+    ``width`` is a width of lines the output will be rendered for,
+    without it, groups which are shown in a row are collapsed into texts.
+    """
+    __slots__ = ('options', 'depth', 'chars', 'limited', 'processed',
+                 'probe_limit', 'probe_exceeded', 'labels', 'labeled',
+                 'deadline', 'timed_out', 'timeout_shown', 'width')
+
+    def __init__(self, options, width=None):
+        self.width = width
+        self.processed = set()
+        self.deadline = None
+        self.timed_out = False
+        self.timeout_shown = False
+        self.depth = 0
+        self.chars = 0
+        self.probe_limit = None
+        self.probe_exceeded = False
+        self.labels = {}
+        # ids of labeled objects, in the order of labeling
+        self.labeled = []
+        self.set_options(options)
+
+    def set_options(self, options):
+        self.options = options
+        self.limited = options.limited or self.probe_limit is not None
+
+        if options.deadline_ms is not None:
+            deadline = perf_counter() + options.deadline_ms / 1000.0
+            if self.deadline is None or deadline < self.deadline:
+                self.deadline = deadline
+
+    def merge_options(self, options):
+        """Extends current options with given ``options``.
+
+        Returns the saved state, which should be passed to
+        :meth:`restore_options` when the options stop applying.
+        Deadline of ``options`` applies only until then too.
+        """
+        saved = (self.options, self.deadline,
+                 self.timed_out, self.timeout_shown)
+        self.set_options(self.options.merge(options))
+        return saved
+
+    def restore_options(self, saved):
+        options, deadline, timed_out, timeout_shown = saved
+        self.set_options(options)
+        if deadline != self.deadline:
+            # the deadline was tightened by the merged options
+            self.deadline = deadline
+            self.timed_out = timed_out
+            self.timeout_shown = timeout_shown
+
+    def is_too_deep(self):
+        max_depth = self.options.max_depth
+        return max_depth is not None and self.depth >= max_depth
+
+    def is_out_of_chars(self):
+        max_chars = self.options.max_chars
+        if max_chars is not None and self.chars >= max_chars:
+            return True
+
+        if self.probe_limit is not None and self.chars >= self.probe_limit:
+            self.probe_exceeded = True
+            return True
+
+        return False
+
+    def is_out_of_time(self):
+        if self.timed_out:
+            return True
+
+        if self.deadline is not None and perf_counter() >= self.deadline:
+            self.timed_out = True
+            timeouts.increment()
+            return True
+
+        return False
+
+    def timeout(self):
+        """Returns a marker for the place where the formatting
+        was stopped by the deadline, or ``None`` if it was shown already."""
+        if self.timeout_shown:
+            return None
+        self.timeout_shown = True
+        return TIMEOUT
+
+    def label(self, value):
+        """Returns a number of the object and a flag
+        telling if it was labeled already."""
+        value_id = id(value)
+        label = self.labels.get(value_id)
+        if label is not None:
+            return label[0], True
+
+        number = len(self.labeled) + 1
+        # object is kept until the end of formatting call,
+        # this way it's id can't be taken by another object
+        self.labels[value_id] = number, value
+        self.labeled.append(value_id)
+        return number, False
+
+    def checkpoint(self):
+        """Returns state of the budget and labels, which
+        should be restored when a layout is thrown away."""
+        return self.chars, len(self.labeled)
+
+    def rollback(self, checkpoint):
+        self.chars, count = checkpoint
+        labeled = self.labeled
+        while len(labeled) > count:
+            del self.labels[labeled.pop()]
+
+    def probe(self, layout, item, budget):
+        """Makes layout of the item if it takes less than
+        ``budget`` characters, otherwise returns ``None``.
+
+        Formatting of the item stops as soon as budget is exhausted,
+        so this is a cheap way to find out if item is short.
+        """
+        checkpoint = self.checkpoint()
+        self.probe_limit = self.chars + budget
+        self.limited = True
+        try:
+            node = layout(item)
+        finally:
+            self.probe_limit = None
+            self.set_options(self.options)
+
+        if self.probe_exceeded:
+            self.probe_exceeded = False
+            self.rollback(checkpoint)
+            return None
+        return node
+
+
+# context of the formatting call which is in progress in this
+# thread or asyncio task, formatting calls don't switch tasks,
+# so they never see contexts of each other
+current_context = ContextVar('magic_repr_context', default=None)
+
+
+def format_with(layout, value, options=None, width=None):
+    """Calls ``layout(value)`` inside of the formatting context.
+
+    If there is no context yet, a new one is created for the output
+    of the given ``width``. Otherwise, it's options are extended
+    with given ``options`` until the layout is done. Budgets are
+    shared in both cases.
+    """
+    context = current_context.get()
+
+    if context is None:
+        token = current_context.set(Context(options or DEFAULT_OPTIONS,
+                                            width))
+        try:
+            return layout(value)
+        finally:
+            current_context.reset(token)
+
+    if options is None:
+        return layout(value)
+
+    saved = context.merge_options(options)
+    try:
+        return layout(value)
+    finally:
+        context.restore_options(saved)
+
+
+class Composite(object):
+    """Description of a value which consists of other values.
+
+    ``entries`` are pairs ``(prefix, value)``, where prefix is
+    a layout node shown before the value, or ``None``. They are
+    taken lazily, so when budgets are exhausted, the rest entries
+    are not touched at all. ``count`` of entries is used to show
+    how many of them were skipped, if it is known.
+
+    Own ``options`` of the value are applied to it's entries.
+
+    ``finish``, if given, is called with the number of characters
+    of the value when it is laid out or streamed.
+    """
+    __slots__ = ('opening', 'entries', 'closing', 'delimiter',
+                 'count', 'limit_items', 'options', 'finish')
+
+    def __init__(self, opening, entries, closing, delimiter=u'',
+                 count=None, limit_items=True, options=None,
+                 finish=None):
+        self.opening = opening
+        self.entries = entries
+        self.closing = closing
+        self.delimiter = delimiter
+        self.count = count
+        self.limit_items = limit_items
+        self.options = options
+        self.finish = finish
+
+
+def more(count=None):
+    """Returns a marker for the items which were not shown."""
+    if count is None:
+        return Text(u'...')
+    return Text(u'...({0} more)'.format(count))
+
+
+TIMEOUT = Text(u'...<timeout>')
+
+MISSING = object()
+
+
+def next_entry(context, composite, entries, idx):
+    """Returns next entry of the composite value if budgets allow it.
+
+    When budgets are exhausted, a marker showing how many entries
+    left is returned instead. ``None`` means there are no more entries.
+    """
+    count = composite.count
+    if count is not None and idx >= count:
+        return None
+
+    if context.deadline is not None and context.is_out_of_time():
+        # outer values are closed without markers
+        return context.timeout()
+
+    max_items = context.options.max_items if composite.limit_items else None
+
+    if (max_items is not None and idx >= max_items) \
+       or context.is_out_of_chars():
+        if count is not None:
+            return more(count - idx)
+        if next(entries, MISSING) is not MISSING:
+            return more()
+        return None
+
+    return next(entries, None)
+
+
+def layout_entry(entry):
+    prefix, value = entry
+    if prefix is None:
+        return layout_value(value)
+
+    current_context.get().chars += prefix.width
+    return prefixed(prefix, layout_value(value))
+
+
+class Level(object):
+    """A composite value which is being laid out by :func:`build`."""
+    __slots__ = ('composite', 'entries', 'items', 'prefix', 'limited',
+                 'saved_options', 'value_id', 'memo_key')
+
+    def __init__(self, composite, limited, saved_options,
+                 value_id, memo_key):
+        self.composite = composite
+        self.entries = iter(composite.entries)
+        self.items = []
+        # prefix of the entry which is being laid out
+        self.prefix = None
+        self.limited = limited
+        self.saved_options = saved_options
+        self.value_id = value_id
+        self.memo_key = memo_key
+
+
+def enter(context, stack, composite, value_id=None, memo_key=None):
+    """Starts layout of the composite value.
+
+    Returns a node if the value is too deep to be shown,
+    otherwise pushes a new level to the stack and returns ``None``.
+    """
+    saved_options = None
+    if composite.options is not None:
+        saved_options = context.merge_options(composite.options)
+
+    if context.is_too_deep():
+        if saved_options is not None:
+            context.restore_options(saved_options)
+        return finish(context, composite, value_id, memo_key,
+                      Text(composite.opening + u'...' + composite.closing))
+
+    context.depth += 1
+    stack.append(Level(composite, context.limited, saved_options,
+                       value_id, memo_key))
+    return None
+
+
+def leave(context, stack):
+    """Finishes layout of the composite value on the top of the stack."""
+    level = stack.pop()
+    context.depth -= 1
+    if level.saved_options is not None:
+        context.restore_options(level.saved_options)
+
+    composite = level.composite
+    node = None
+    if context.width is None:
+        node = collapse(composite, level.items)
+    if node is None:
+        node = Concat(Text(composite.opening),
+                      Group(level.items, delimiter=composite.delimiter),
+                      Text(composite.closing))
+    return finish(context, composite, level.value_id, level.memo_key, node)
+
+
+def collapse(composite, items):
+    """Returns a text of the composite value if it's items are texts
+    which are shown in a row, otherwise returns ``None``.
+
+    The text is rendered the same way as the group, but it is cheaper
+    to keep and to render. Groups are not collapsed when output
+    is fitted into a width, because they can be split into lines then.
+    """
+    length = 0
+    for item in items:
+        if type(item) is not Text or item.multiline:
+            return None
+        length += item.width
+
+    if length > MAX_LENGTH:
+        return None
+
+    return Text(composite.opening +
+                (composite.delimiter + u' ').join([item.text
+                                                   for item in items]) +
+                composite.closing)
+
+
+def prefixed(prefix, node):
+    """Returns the node after the prefix. Texts are joined
+    right away when it doesn't change how they are aligned."""
+    if type(node) is Text and type(prefix) is Text and not node.multiline:
+        return Text(prefix.text + node.text)
+    return Concat(prefix, node)
+
+
+def finish(context, composite, value_id, memo_key, node):
+    if composite.finish is not None:
+        composite.finish(node.width)
+    if value_id is not None:
+        context.processed.discard(value_id)
+    if memo_key is not None:
+        context.options.memo.put(memo_key, node)
+    return node
+
+
+def start(context, stack, value):
+    """Starts layout of the value.
+
+    Returns the node if value is laid out right away, or ``None``
+    if it is a composite value and a new level was pushed to the stack.
+    """
+    key = None
+    memo = context.options.memo
+    if memo is not None:
+        key = memo_key(context, value)
+        if key is not None:
+            node = memo.get(key)
+            if node is not None:
+                context.chars += node.width
+                return node
+
+    if type(value) in registry.atoms:
+        # atoms can't contain other values, so
+        # they can't be a part of recursion
+        node = describe_atom(context, value)
+        if key is not None:
+            memo.put(key, node)
+        return node
+
+    processed = context.processed
+    value_id = id(value)
+
+    if value_id in processed:
+        return recursion(context, value)
+
+    processed.add(value_id)
+
+    try:
+        described = describe_value(context, value)
+        if isinstance(described, Composite):
+            return enter(context, stack, described, value_id, key)
+    except Exception:
+        processed.discard(value_id)
+        raise
+
+    processed.discard(value_id)
+    if key is not None:
+        memo.put(key, described)
+    return described
+
+
+def run(context, stack, node):
+    """Lays out levels from the stack until it is empty.
+
+    Nested values don't make recursive calls, instead they
+    push their levels to the stack, this way values of any depth
+    can be laid out. ``node`` is a layout of the value which was
+    just finished, or ``None``.
+    """
+    atoms = registry.atoms
+    try:
+        while stack:
+            level = stack[-1]
+            composite = level.composite
+            entries = level.entries
+            items = level.items
+            limited = level.limited
+
+            if node is not None:
+                # layout of the nested composite value is ready
+                prefix = level.prefix
+                items.append(node if prefix is None
+                             else prefixed(prefix, node))
+
+            # lay out entries of this level, until one of them
+            # is a composite value and it's level is pushed
+            while True:
+                if limited:
+                    entry = next_entry(context, composite,
+                                       entries, len(items))
+                else:
+                    entry = next(entries, None)
+
+                if entry is None:
+                    node = leave(context, stack)
+                    break
+
+                if isinstance(entry, Text):
+                    # marker of skipped entries, nothing will follow it
+                    items.append(entry)
+                    node = leave(context, stack)
+                    break
+
+                prefix, value = entry
+                if prefix is not None and limited:
+                    context.chars += prefix.width
+
+                if type(value) in atoms and context.options.memo is None:
+                    # the same as start does, but atoms are
+                    # the most common values, so calls are saved
+                    node = Text(repr(value))
+                    context.chars += node.width
+                else:
+                    node = start(context, stack, value)
+                    if node is None:
+                        level.prefix = prefix
+                        break
+
+                items.append(node if prefix is None
+                             else prefixed(prefix, node))
+
+    except BaseException:
+        # unwind levels which were not finished
+        while stack:
+            level = stack.pop()
+            context.depth -= 1
+            if level.saved_options is not None:
+                context.restore_options(level.saved_options)
+            if level.value_id is not None:
+                context.processed.discard(level.value_id)
+        raise
+
+    return node
+
+
+def build(context, composite):
+    """Makes layout of the composite value."""
+    stack = []
+    return run(context, stack, enter(context, stack, composite))
+
+
+def layout_leaf(context, text):
+    """Makes a leaf node and takes it's width from the budget."""
+    node = Text(text)
+    context.chars += node.width
+    return node
+
+
+def layout_string(context, template, text):
+    """Makes a leaf node for the string, cutting it
+    to ``max_string`` characters."""
+    max_string = context.options.max_string
+    if max_string is not None and len(text) > max_string:
+        return layout_leaf(
+            context,
+            template.format(text[:max_string]) +
+            u'...({0} more)'.format(len(text) - max_string))
+    return layout_leaf(context, template.format(text))
+
+
+def describe_atom(context, value):
+    return layout_leaf(context, repr(value))
+
+
+def describe_bytes(context, value):
+    # suppose, all byte strings are in unicode
+    # don't know if everybody in the world uses anything else?
+    max_string = context.options.max_string
+    if max_string is not None and len(value) > max_string:
+        text = value[:max_string].decode('utf-8', 'ignore')
+        return layout_leaf(
+            context,
+            u"'{0}'...({1} more)".format(
+                text, len(value) - max_string))
+    return layout_leaf(context,
+                       u"'{0}'".format(value.decode('utf-8')))
+
+
+def describe_text(context, value):
+    return layout_string(context, u"u'{0}'", value)
+
+
+def describe_sequence(context, value):
+    if context.options.table:
+        table = describe_table(context, value)
+        if table is not None:
+            return table
+
+    # long lists or lists with multiline items
+    # will be shown vertically
+    return Composite(u'[', ((None, item) for item in value), u']',
+                     delimiter=u',', count=len(value))
+
+
+def cell_text(node):
+    if isinstance(node, Text):
+        return node.text
+    return render(node)
+
+
+def layout_rows(context, items, cls, describe):
+    """Returns texts of field names, texts of field values for each
+    of the objects and their descriptions. Returns ``None`` if objects
+    are not of the class ``cls``, are laid out already, have different
+    fields or some of the values are multiline.
+
+    Objects are described and laid out one by one, until ``max_chars``
+    are exhausted or the deadline is reached, so fields of objects
+    which are not shown are not taken at all.
+    """
+    processed = context.processed
+    prefixes = None
+    rows = []
+    described = []
+
+    for item in items:
+        if context.limited and (context.is_out_of_chars() or
+                                context.deadline is not None and
+                                context.is_out_of_time()):
+            break
+
+        if type(item) is not cls or id(item) in processed:
+            return None
+
+        composite = describe(item)
+        entries = list(composite.entries)
+        row_prefixes = [prefix.text for prefix, _ in entries]
+        if prefixes is None:
+            prefixes = row_prefixes
+            if not prefixes:
+                return None
+        elif row_prefixes != prefixes:
+            return None
+
+        # fields can refer to the object itself
+        processed.add(id(item))
+        try:
+            row = [layout_value(field_value) for _, field_value in entries]
+        finally:
+            processed.discard(id(item))
+
+        if any(node.multiline for node in row):
+            return None
+        rows.append([cell_text(node) for node in row])
+        described.append(composite)
+
+    if prefixes is None:
+        return None
+    return prefixes, rows, described
+
+
+def describe_table(context, value):
+    """Lays out a list of objects of the same class with ``__repr__``
+    made by ``make_repr`` as a table::
+
+      [Point: x   y  label
+              1   2  u'a'
+              10  3  u'b']
+
+    Returns ``None`` if objects can't be shown this way: they have
+    different fields, some values are multiline, or objects are
+    too deep or referenced.
+    """
+    options = context.options
+    if len(value) < 2 or options.references:
+        return None
+
+    cls = type(value[0])
+    describe = getattr(cls.__repr__, 'magic_repr_describe', None)
+    if describe is None:
+        return None
+
+    # values of fields are on the second level from here
+    max_depth = options.max_depth
+    if max_depth is not None and context.depth + 1 >= max_depth:
+        return None
+
+    items = value
+    if options.max_items is not None:
+        items = value[:options.max_items]
+
+    checkpoint = context.checkpoint()
+    saved_options = None
+    if describe.options is not None:
+        saved_options = context.merge_options(describe.options)
+    context.depth += 2
+    try:
+        table = layout_rows(context, items, cls, describe)
+    finally:
+        context.depth -= 2
+        if saved_options is not None:
+            context.restore_options(saved_options)
+
+    if table is None:
+        context.rollback(checkpoint)
+        return None
+    prefixes, rows, described = table
+
+    # prefixes are "name="
+    header = [prefix[:-1] for prefix in prefixes]
+    widths = [max(len(row[idx]) for row in chain([header], rows))
+              for idx in range(len(header))]
+    lines = [u'  '.join([cell.ljust(width)
+                         for cell, width in zip(row[:-1], widths)] +
+                        [row[-1]])
+             for row in chain([header], rows)]
+
+    if context.timed_out:
+        marker = context.timeout()
+        if marker is not None:
+            lines.append(marker.text)
+    elif len(rows) < len(value):
+        lines.append(u'...({0} more)'.format(len(value) - len(rows)))
+
+    for composite, line in zip(described, lines[1:len(rows) + 1]):
+        if composite.finish is not None:
+            composite.finish(len(line))
+
+    opening = u'[{0}: '.format(cls.__name__)
+    context.chars += len(opening) + len(lines[0])
+    return Text(opening + (u'\n' + u' ' * len(opening)).join(lines) + u']')
+
+
+COLON = Text(u': ')
+
+
+def dict_entries(value):
+    context = current_context.get()
+
+    # keys are needed for sorting, but their widths are taken from
+    # the budget only when they are shown. Atoms and strings are
+    # sorted by their texts, which are cheap to make, and they are
+    # laid out only when shown. Other keys are laid out right away,
+    # calling layout_value recursively, each with the same budget
+    chars = context.chars
+    atoms = registry.atoms
+    texts = registry.dispatch(str) is describe_text
+    max_string = context.options.max_string
+    items = []
+    for key, item_value in value.items():
+        cls = type(key)
+        node = None
+        if cls in atoms:
+            text = repr(key)
+        elif cls is str and texts and \
+                (max_string is None or len(key) <= max_string):
+            text = u"u'" + key + u"'"
+        else:
+            node = layout_value(key)
+            text = render(node)
+            context.chars = chars
+        items.append((text, node, item_value))
+
+        if context.deadline is not None and context.is_out_of_time():
+            # there is no time to sort the keys, entries are
+            # shown in the order of insertion until the marker
+            for text, node, item_value in items:
+                yield key_prefix(text, node), item_value
+            return
+
+    if len(set([text for text, _, _ in items])) != len(items):
+        # some keys look the same, so they are sorted by
+        # values too, these layouts of values are thrown away
+        checkpoint = context.checkpoint()
+        sort_keys = [(text, render(layout_value(item_value)))
+                     for text, _, item_value in items]
+        context.rollback(checkpoint)
+
+        items = [item for _, item in
+                 sorted(zip(sort_keys, items), key=itemgetter(0))]
+    elif context.limited:
+        # entries are taken until the budget is exhausted, so
+        # keys are taken from the heap one by one, and keys which
+        # are not shown are not sorted. Texts are unique, so
+        # nodes and values are not compared
+        from heapq import heapify, heappop
+        heapify(items)
+        while items:
+            text, node, item_value = heappop(items)
+            yield key_prefix(text, node), item_value
+        return
+    else:
+        items.sort(key=itemgetter(0))
+
+    for text, node, item_value in items:
+        yield key_prefix(text, node), item_value
+
+
+def key_prefix(text, node):
+    """Returns a prefix of the dict's entry for the key which was
+    laid out to the ``node``, or which is an atom or a string
+    shown as ``text`` if there is no node."""
+    if node is None:
+        return Text(text + u': ')
+    return prefixed(node, COLON)
+
+
+def layout_key(context, key):
+    # width of the key is taken from the budget
+    # only when the entry is shown
+    chars = context.chars
+    node = layout_value(key)
+    context.chars = chars
+    return prefixed(node, COLON)
+
+
+def insertion_entries(context, value):
+    for key, item_value in value.items():
+        yield layout_key(context, key), item_value
+
+
+def key_sorted_entries(context, value):
+    max_items = context.options.max_items
+    try:
+        if max_items is not None and max_items < len(value):
+            # only shown keys are selected, other
+            # ones are not sorted and not formatted
+            from heapq import nsmallest
+            keys = nsmallest(max_items, value)
+        else:
+            keys = sorted(value)
+    except TypeError:
+        # keys can't be compared to each other
+        for entry in dict_entries(value):
+            yield entry
+        return
+
+    for key in keys:
+        yield layout_key(context, key), value[key]
+
+
+def describe_dict(context, value):
+    # keys are sorted when the first entry is requested,
+    # this way nothing is done for too deep dicts
+    order = context.options.dict_order
+    if order == 'insertion':
+        entries = insertion_entries(context, value)
+    elif order == 'keys':
+        entries = key_sorted_entries(context, value)
+    else:
+        entries = dict_entries(value)
+
+    return Composite(u'{', entries, u'}',
+                     delimiter=u',', count=len(value))
 
-    have_multiline_items = any(map(is_multiline, lst))
-    result_will_be_too_long = sum(map(len, lst)) > max_length
 
-    if have_multiline_items or result_will_be_too_long:
-        padding = len(out)
-        add_padding = padding_adder(padding)
+def iter_entries(value):
+    return ((None, item) for item in value)
 
-        # we need to add padding to all lines
-        # except the first one
-        head, rest = cut_head(lst)
-        rest = map(add_padding, rest)
 
-        # add padding to the head, but not for it's first line
-        head = add_padding(head, ignore_first_line=True)
+def describe_set(context, value):
+    name = type(value).__name__
+    if not value:
+        return layout_leaf(context, name + u'()')
 
-        # now join lines back
-        lst = chain((head,), rest)
-        delimiter += u'\n'
+    if type(value) is set:
+        opening, closing = u'{', u'}'
     else:
-        delimiter += u' '
+        opening, closing = name + u'({', u'})'
 
-    return out + delimiter.join(lst)
+    # items are taken lazily, so only shown ones are touched
+    return Composite(opening, iter_entries(value), closing,
+                     delimiter=u',', count=len(value))
 
 
-class RecursionBreaker(threading.local):
+def describe_view(context, value):
+    return Composite(type(value).__name__ + u'([', iter_entries(value),
+                     u'])', delimiter=u',', count=len(value))
+
+
+def is_iterator(value):
+    """Checks if the value is an iterator like ``collections.abc.Iterator``
+    does, without importing it."""
+    cls = type(value)
+    return hasattr(cls, '__next__') and hasattr(cls, '__iter__')
+
+
+def describe_iterator(context, value):
+    # there is no way to know how many items are left, so
+    # one more item is taken to find out if there are any
+    return Composite(u'<{0} ['.format(type(value).__name__),
+                     iter_entries(value), u']>', delimiter=u',')
+
+
+def type_name(cls):
+    return u'{0}.{1}'.format(getattr(cls, '__module__', None), cls.__name__)
+
+
+class Registry(object):
+    """Formatters of values, by their types.
+
+    Formatter is a function ``(context, value)`` which returns
+    a leaf node or a :class:`Composite`. It is looked up by
+    the value's type and its bases in the MRO order, like
+    ``functools.singledispatch`` does, and the result of the lookup
+    is cached per type.
+
+    Types from ``atoms`` are formatted with :func:`describe_atom`
+    without any lookups.
+
+    Formatters of types from optional libraries and from modules
+    which ``magic_repr`` doesn't import itself are registered
+    by modules from ``lazy``, which are imported when
+    the first value of such type is formatted.
+    """
+
+    max_cached = 1024
+
     def __init__(self):
-        super(RecursionBreaker, self).__init__()
-        self.processed = set()
+        self.formatters = {}
+        self.cache = {}
+        self.atoms = set()
+        self.lazy = {}
+
+    def register(self, cls, formatter):
+        self.formatters[cls] = formatter
+        # user's formatter replaces the default one
+        self.atoms.discard(cls)
+        self.cache.clear()
+
+    def register_default(self, cls, formatter):
+        """Registers a formatter unless there is one for this type
+        already. This way modules from ``lazy`` don't replace
+        formatters registered by users before they were imported."""
+        if cls not in self.formatters:
+            self.register(cls, formatter)
+
+    def register_atoms(self, *classes):
+        for cls in classes:
+            self.register(cls, describe_atom)
+            self.atoms.add(cls)
+
+    def register_lazy(self, name, module):
+        """Registers a module which should be imported
+        to get formatter for the type with full ``name``,
+        like ``numpy.ndarray``."""
+        self.lazy[name] = module
+
+    def load_lazy(self, mro):
+        """Imports modules with formatters for the types from ``mro``."""
+        for klass in mro:
+            module = self.lazy.pop(type_name(klass), None)
+            if module is not None:
+                __import__(module)
+
+    def dispatch(self, cls):
+        """Returns formatter for the type or ``None``
+        if values of this type should be formatted with ``repr``."""
+        try:
+            return self.cache[cls]
+        except KeyError:
+            pass
+
+        mro = getattr(cls, '__mro__', (cls,))
+        if self.lazy:
+            self.load_lazy(mro)
+
+        formatters = self.formatters
+        formatter = None
+        for klass in mro:
+            if klass in formatters:
+                formatter = formatters[klass]
+                break
+
+        if len(self.cache) >= self.max_cached:
+            # dynamically created classes should not be kept forever
+            self.cache.clear()
+        self.cache[cls] = formatter
+        return formatter
+
+
+registry = Registry()
+registry.register_atoms(int, float, bool, type(None))
+registry.register(bytes, describe_bytes)
+registry.register(str, describe_text)
+registry.register(list, describe_sequence)
+registry.register(tuple, describe_sequence)
+registry.register(dict, describe_dict)
+registry.register(set, describe_set)
+registry.register(frozenset, describe_set)
+registry.register(type({}.keys()), describe_view)
+registry.register(type({}.values()), describe_view)
+registry.register(type({}.items()), describe_view)
+registry.register_lazy(u'collections.deque', 'magic_repr.containers')
+registry.register_lazy(u'collections.OrderedDict', 'magic_repr.containers')
+registry.register_lazy(u'numpy.ndarray', 'magic_repr.arrays')
+
+
+def register_formatter(cls, formatter=None):
+    """Registers a function which formats values of the given type
+    and its subclasses.
+
+    Formatter gets a value and returns its text. Can be used
+    as a decorator::
+
+      @register_formatter(Decimal)
+      def format_decimal(value):
+          return u'{0:.2f}'.format(value)
+    """
+    if formatter is None:
+        return lambda formatter: register_formatter(cls, formatter)
+
+    def describe(context, value):
+        return layout_leaf(context, formatter(value))
+
+    registry.register(cls, describe)
+    return formatter
+
+
+def describe_value(context, value):
+    """Returns a leaf node for simple values
+    and :class:`Composite` for values which consist of others.
+    """
+    cls = type(value)
+    formatter = registry.dispatch(cls)
+    if formatter is not None and cls in registry.formatters:
+        return formatter(context, value)
+
+    # objects with __repr__ made by make_repr describe their fields,
+    # even if they inherit from a type with a formatter, like
+    # named tuples do
+    describe = getattr(cls.__repr__, 'magic_repr_describe', None)
+    if describe is not None:
+        return describe_object(context, value, describe)
+
+    if formatter is not None:
+        return formatter(context, value)
 
+    if context.options.consume_iterators and is_iterator(value):
+        return describe_iterator(context, value)
 
-recursion_breaker = RecursionBreaker()
+    return layout_leaf(context, repr(value))
 
 
-def format_value(value):
+def describe_object(context, value, describe):
+    """Describes an object with ``__repr__`` made by ``make_repr``.
+
+    When references are turned on, each object is described once
+    during the formatting call and gets a number. Other occurrences
+    of it are shown as references to this number.
+    """
+    # references can be turned on by the object's own options
+    options = describe.options
+    if not (context.options.references or
+            options is not None and options.references):
+        # compiled layout is fast, but it can't check limits
+        compiled = describe.compiled
+        if compiled is not None and not context.limited \
+           and instrumentation is None:
+            return compiled(value, context)
+        return describe(value)
+
+    number, shown = context.label(value)
+    if shown:
+        return reference(context, value, number)
+
+    composite = describe(value)
+    composite.opening += u'#{0} '.format(number)
+    return composite
+
+
+def reference(context, value, number):
+    return layout_leaf(context, u'<{0} #{1}>'.format(
+        value.__class__.__name__, number))
+
+
+def recursion(context, value):
+    """Returns a node for the value which is being laid out already.
+
+    An object which got a number when references are turned on
+    is shown as a reference, other values as ``<recursion>``.
+    """
+    label = context.labels.get(id(value))
+    if label is not None:
+        return reference(context, value, label[0])
+    return Text(u'<recursion>')
+
+
+def layout_value(value):
+    """Returns a layout tree for the value.
+
+    Nested values are not rendered to strings, their
+    layout trees become a part of the value's tree instead.
+    """
+    context = current_context.get()
+    if context is None:
+        return format_with(layout_value, value)
+
+    stack = []
+    node = start(context, stack, value)
+    if not stack:
+        return node
+    return run(context, stack, node)
+
+
+def format_value(value, **options):
     """This function should return unicode representation of the value
+
+    Keyword arguments are limits described in :class:`Options`, like
+    ``format_value(value, max_items=10)``.
     """
-    value_id = id(value)
+    options = Options(**options) if options else None
+    width = top_width(value, options)
+    return render(format_with(layout_value, value, options, width), width)
+
 
-    if value_id in recursion_breaker.processed:
-        return u'<recursion>'
+def format_bytes(value, encoding='utf-8', buffer=None, chunk_size=8192,
+                 **options):
+    """Returns representation of the value encoded into bytes, the same
+    as ``format_value(value).encode(encoding)``.
 
-    recursion_breaker.processed.add(value_id)
+    Value is streamed like by :func:`iter_repr`, and chunks of text
+    are encoded as soon as they are rendered, so neither the layout
+    of the whole value nor it's whole text are kept in memory.
 
+    If ``buffer`` is given, it should be a ``bytearray`` or a binary
+    file-like object, like ``io.BytesIO``. Output is appended to it
+    and nothing is returned.
+
+    Keyword arguments are limits described in :class:`Options`.
+    """
+    from codecs import getincrementalencoder
+
+    streamer = Streamer(value, Options(**options) if options else None)
+    # encodings like utf-16 start the output with a BOM
+    # only once, so chunks are encoded by one encoder
+    encode = getincrementalencoder(encoding)().encode
+
+    if buffer is None:
+        parts = []
+        write = parts.append
+    elif isinstance(buffer, bytearray):
+        write = buffer.extend
+    else:
+        write = buffer.write
+
+    while True:
+        chunks = streamer.run(chunk_size)
+        if not chunks:
+            break
+        write(encode(u''.join(chunks)))
+    write(encode(u'', True))
+
+    if buffer is None:
+        return b''.join(parts)
+    return None
+
+
+def top_width(value, options):
+    """Returns width of lines for the formatting call.
+
+    It is taken from the call's options, or from
+    the options of the formatted object's class.
+    """
+    if options is not None and options.width is not None:
+        return options.width
+
+    describe = getattr(type(value).__repr__, 'magic_repr_describe', None)
+    own_options = getattr(describe, 'options', None)
+    if own_options is not None:
+        return own_options.width
+    return None
+
+
+def layout_top_value(value):
+    """Makes layout of the value like ``repr`` does.
+
+    Unlike :func:`layout_value`, objects with ``__repr__`` made by
+    ``make_repr`` don't mark themselves as processed, so they are
+    shown once again if they are reachable from their fields.
+    """
+    layout = getattr(type(value).__repr__, 'magic_repr_layout', None)
+    if layout is not None:
+        return layout(value)
+    return layout_value(value)
+
+
+class LazyRepr(object):
+    """Representation of the value which is made only when
+    it is converted to a string, and only once.
+
+    Useful for logging, because messages are formatted only if
+    some handler emits them::
+
+      logger.debug('Processing %s', lazy_repr(order, max_items=10))
+    """
+    __slots__ = ('value', 'options', 'text')
+
+    def __init__(self, value, **options):
+        self.value = value
+        self.options = Options(**options) if options else None
+        self.text = None
+
+    def format(self):
+        """Returns representation of the value as unicode."""
+        text = self.text
+        if text is None:
+            width = top_width(self.value, self.options)
+            text = render(format_with(layout_top_value, self.value,
+                                      self.options, width),
+                          width)
+            self.text = text
+        return text
+
+    def __str__(self):
+        return self.format()
+
+    __repr__ = __str__
+
+
+def lazy_repr(value, **options):
+    """Returns an object which formats the value when it is
+    converted to a string, see :class:`LazyRepr`.
+
+    Keyword arguments are limits described in :class:`Options`.
+    """
+    return LazyRepr(value, **options)
+
+
+# values with more nested values are formatted by arepr in an executor
+INLINE_SIZE = 1000
+
+
+def is_small(value, limit):
+    """Checks if the value contains no more than ``limit`` nested
+    values, looking at no more than ``limit`` of them.
+
+    Items of lists, tuples, sets and dicts and attributes of objects
+    are counted, lengths of containers are known in advance,
+    so big containers are not iterated at all.
+    """
+    queue = [value]
+    # queue grows while it's iterated
+    for item in queue:
+        if isinstance(item, dict):
+            items = item.values()
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            items = item
+        else:
+            items = getattr(item, '__dict__', None)
+            if not isinstance(items, dict):
+                continue
+            items = items.values()
+
+        if len(queue) + len(items) > limit:
+            return False
+        queue.extend(items)
+    return True
+
+
+async def arepr(value, executor=None, inline_size=INLINE_SIZE, **options):
+    """Returns representation of the value like ``repr`` does,
+    without blocking the event loop for a long time.
+
+    Values with more than ``inline_size`` nested values are formatted
+    in the ``executor``, by default in the event loop's default one,
+    and the value should not be changed until it's done.
+    Smaller values are formatted right away, because passing
+    them to another thread takes longer.
+
+    Keyword arguments are limits described in :class:`Options`.
+    """
+    formatter = LazyRepr(value, **options)
+    if is_small(value, inline_size):
+        return formatter.format()
+
+    import asyncio
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, formatter.format)
+
+
+class Pending(object):
+    """A value which should be streamed, after the ``prefix``.
+
+    ``trail`` is a width of the text which follows it
+    on the same line, see :func:`render_fitted`.
+    """
+    __slots__ = ('value', 'register', 'prefix', 'trail')
+
+    def __init__(self, value, register=True, prefix=None, trail=0):
+        self.value = value
+        self.register = register
+        self.prefix = prefix
+        self.trail = trail
+
+
+class Frame(object):
+    """A composite value which is being streamed.
+
+    First entries are collected into the ``buffer`` until it is
+    clear if they should be shown in a row or in a column. In the
+    latter case the rest of entries are streamed one by one.
+    """
+    __slots__ = ('composite', 'entries', 'value_id', 'saved_options',
+                 'trail', 'column', 'buffer', 'length', 'vertical',
+                 'pending', 'emitted', 'index', 'started', 'peeked')
+
+    def __init__(self, composite, value_id, saved_options, trail=0,
+                 started=0):
+        self.composite = composite
+        # how many characters were written before the value
+        self.started = started
+        self.entries = iter(composite.entries)
+        self.value_id = value_id
+        self.saved_options = saved_options
+        self.trail = trail
+        self.column = None
+        self.buffer = []
+        self.length = 0
+        self.vertical = False
+        self.pending = None
+        self.emitted = 0
+        self.index = 0
+        # an entry which was taken to find out if there are more
+        self.peeked = None
+
+
+class Streamer(object):
+    """Renders a value chunk by chunk.
+
+    Layout tree is not built for the whole value. Instead, entries
+    of lists, dicts and objects are laid out and rendered one by one,
+    so memory used by the streamer does not depend on the size
+    of the output.
+
+    Streamer has it's own formatting context which is activated
+    only while :meth:`run` works, so it can be paused between chunks.
+    """
+
+    def __init__(self, value, options=None):
+        self.width = top_width(value, options)
+        self.context = Context(options or DEFAULT_OPTIONS, self.width)
+        self.processed = self.context.processed
+        self.column = 0
+        self.written = 0
+
+        # make_repr's __repr__ does not mark the object itself
+        # as processed, and streamer should do the same
+        register = getattr(type(value).__repr__,
+                           'magic_repr_describe', None) is None
+        self.stack = [Pending(value, register=register)]
+
+    def run(self, size):
+        """Renders at least ``size`` characters, if there are
+        so many left. Returns a list of chunks, which is
+        empty when everything was rendered."""
+        token = current_context.set(self.context)
+
+        chunks = []
+        started = self.written
+
+        def write(chunk):
+            chunks.append(chunk)
+            self.written += len(chunk)
+
+        stack = self.stack
+        push = stack.append
+        width = self.width
+
+        try:
+            while stack and self.written - started < size:
+                node = stack.pop()
+
+                if isinstance(node, Pending):
+                    self.open(node)
+                elif isinstance(node, Frame):
+                    self.step(node)
+                elif isinstance(node, tuple):
+                    self.column = render_fitted(node, self.column,
+                                                write, push, width)
+                else:
+                    self.column = render_node(node, self.column, write, push)
+        finally:
+            current_context.reset(token)
+
+        return chunks
+
+    def push_node(self, node, trail):
+        if self.width is None:
+            self.stack.append(node)
+        else:
+            self.stack.append((node, False, trail))
+
+    def push_leaf(self, pending, node):
+        if pending.prefix is not None:
+            node = Concat(pending.prefix, node)
+        self.push_node(node, pending.trail)
+
+    def open(self, pending):
+        """Starts streaming of the value."""
+        context = self.context
+        value = pending.value
+        value_id = id(value) if pending.register else None
+
+        if value_id is not None:
+            if value_id in self.processed:
+                self.push_leaf(pending, recursion(context, value))
+                return
+            self.processed.add(value_id)
+
+        try:
+            described = describe_value(context, value)
+        except Exception:
+            self.processed.discard(value_id)
+            raise
+
+        if not isinstance(described, Composite):
+            self.processed.discard(value_id)
+            self.push_leaf(pending, described)
+            return
+
+        saved_options = None
+        if described.options is not None:
+            saved_options = context.merge_options(described.options)
+
+        if context.is_too_deep():
+            if saved_options is not None:
+                context.restore_options(saved_options)
+            self.processed.discard(value_id)
+            self.push_leaf(pending, Text(described.opening + u'...' +
+                                         described.closing))
+            return
+
+        context.depth += 1
+        started = self.written
+        if pending.prefix is not None:
+            started += pending.prefix.width
+        self.stack.append(Frame(described, value_id, saved_options,
+                                pending.trail, started))
+        self.stack.append(described.opening)
+        if pending.prefix is not None:
+            # nested value is not a text, so nothing
+            # is counted as prefix's trail
+            self.push_node(pending.prefix, 0)
+
+    def close(self, frame, unwritten=0):
+        """Finishes streaming of the value, ``unwritten`` is a number
+        of it's characters which are not written yet."""
+        context = self.context
+        context.depth -= 1
+        if frame.saved_options is not None:
+            context.restore_options(frame.saved_options)
+        self.processed.discard(frame.value_id)
+        composite = frame.composite
+        if composite.finish is not None:
+            composite.finish(self.written - frame.started + unwritten +
+                             len(composite.closing))
+        self.stack.append(composite.closing)
+
+    def next_entry(self, frame):
+        if frame.index is None:
+            return None
+
+        entries = frame.entries
+        if frame.peeked is not None:
+            entries = chain((frame.peeked,), entries)
+            frame.peeked = None
+
+        entry = next_entry(self.context, frame.composite,
+                           entries, frame.index)
+
+        if entry is None or isinstance(entry, Text):
+            # there will be no more entries
+            frame.index = None
+        else:
+            frame.index += 1
+        return entry
+
+    def is_last(self, frame):
+        """Checks if the item which was just taken from the frame
+        is the last one, so nothing but closings follows it.
+
+        Entries which are left don't depend on budgets, because
+        if some of them are skipped, a marker follows the item.
+        """
+        if frame.buffer or frame.pending is not None or \
+           frame.peeked is not None:
+            return False
+        if frame.index is None:
+            return True
+
+        count = frame.composite.count
+        if count is not None:
+            return frame.index >= count
+
+        entry = next(frame.entries, MISSING)
+        if entry is MISSING:
+            frame.index = None
+            return True
+        frame.peeked = entry
+        return False
+
+    def step(self, frame):
+        """Makes one step of the composite value's streaming."""
+        context = self.context
+        stack = self.stack
+
+        delimiter = frame.composite.delimiter
+        width = self.width
+
+        if frame.column is None:
+            # opening was written just now
+            frame.column = self.column
+
+        if width is None:
+            max_length = MAX_LENGTH
+        else:
+            # group should fit into the line together with the closing
+            max_length = width - frame.column - frame.trail - \
+                len(frame.composite.closing)
+            # row of items is as wide as items and delimiters between them
+            spacing = len(delimiter) + 1
+
+        while not frame.vertical:
+            entry = self.next_entry(frame)
+
+            if entry is None:
+                # all entries are short enough to be
+                # shown in a row, or group will decide
+                group = Group(frame.buffer, delimiter=delimiter)
+                self.close(frame, group.width)
+                if width is None:
+                    stack.append(group)
+                else:
+                    stack.append((group, True, 0))
+                return
+
+            if width is not None and frame.buffer:
+                frame.length += spacing
+
+            if isinstance(entry, Text):
+                node = entry
+            else:
+                # we don't know yet how to show entries, so
+                # try to make a layout of short ones only
+                budget = max_length - frame.length + 1
+                node = context.probe(layout_entry, entry, budget)
+
+            if node is None:
+                frame.vertical = True
+                frame.pending = entry
+            else:
+                frame.buffer.append(node)
+                frame.length += node.width
+                if width is None:
+                    frame.vertical = node.multiline or \
+                        frame.length > max_length
+                else:
+                    frame.vertical = node.hard or \
+                        frame.length > max_length
+
+        if frame.buffer:
+            item = frame.buffer.pop(0)
+        elif frame.pending is not None:
+            item = frame.pending
+            frame.pending = None
+        else:
+            item = self.next_entry(frame)
+            if item is None:
+                self.close(frame)
+                return
+
+        stack.append(frame)
+
+        # in a column, each item is followed by the delimiter,
+        # and the last one by closings of this and outer values
+        trail = len(delimiter)
+        if width is not None and self.is_last(frame):
+            trail = frame.trail + len(frame.composite.closing)
+
+        if isinstance(item, tuple):
+            prefix, value = item
+            if prefix is not None:
+                context.chars += prefix.width
+            stack.append(Pending(value, prefix=prefix, trail=trail))
+        else:
+            self.push_node(item, trail)
+
+        if frame.emitted:
+            stack.append(delimiter + u'\n' + u' ' * frame.column)
+        frame.emitted += 1
+
+
+def iter_repr(value, chunk_size=8192, **options):
+    """Yields unicode representation of the value by chunks.
+
+    Output is the same as from ``format_value``, or ``repr``
+    for objects with ``__repr__`` made by ``make_repr``, but it is not
+    kept in memory as a whole. Chunks have about ``chunk_size``
+    characters each.
+
+    Keyword arguments are limits described in :class:`Options`.
+    """
+    streamer = Streamer(value, Options(**options) if options else None)
+
+    while True:
+        chunks = streamer.run(chunk_size)
+        if not chunks:
+            break
+        yield u''.join(chunks)
+
+
+def write_repr(value, stream, encoding=None, chunk_size=8192, **options):
+    """Writes representation of the value into the file-like object.
+
+    Binary streams get the text encoded with ``encoding``, which
+    is utf-8 by default. If ``encoding`` is given, text is encoded
+    for any stream.
+    """
+    if encoding is None and \
+       isinstance(stream, (io.RawIOBase, io.BufferedIOBase)):
+        encoding = 'utf-8'
+
+    for chunk in iter_repr(value, chunk_size=chunk_size, **options):
+        if encoding is not None:
+            chunk = chunk.encode(encoding)
+        stream.write(chunk)
+
+
+def batch_layout(describe):
+    """Returns compiled layout for objects with ``__repr__`` made by
+    ``make_repr``, or ``None`` if their fields can't be compiled.
+
+    Layout is compiled on the first use, even if ``make_repr``
+    wasn't asked to compile it, because in a batch it's cost
+    is shared by all objects of the class.
+    """
+    compiled = describe.compiled
+    if compiled is None and describe.fields is not None:
+        compiled = describe.batch_compiled
+        if compiled is None:
+            field_names, getters = describe.fields
+            compiled = describe.batch_compiled = compile_layout(
+                field_names, getters, describe.options)
+    return compiled
+
+
+def class_plan(value, options, compiling):
+    """Returns what formatting of values of the value's class
+    needs: a width of lines, a compiled layout and a beginning
+    of the object's text. Last two are ``None`` if objects of
+    the class can't be laid out by a compiled layout, or
+    if ``compiling`` is false.
+    """
+    width = top_width(value, options)
+    cls = type(value)
+    describe = getattr(cls.__repr__, 'magic_repr_describe', None)
+    if not compiling or describe is None:
+        return width, None, None
+
+    own_options = describe.options
+    if own_options is not None and own_options.references:
+        return width, None, None
+
+    compiled = batch_layout(describe)
+    if compiled is None:
+        return width, None, None
+    return width, compiled, u'<{0} '.format(cls.__name__)
+
+
+def build_current(composite):
+    return build(current_context.get(), composite)
+
+
+def iter_formatted(values, options):
+    """Yields representations of the values like ``repr`` makes them.
+
+    Everything which depends only on the class of the value is
+    made once per class by :func:`class_plan`. When budgets are not
+    checked, objects with explicit fields are laid out by compiled
+    layouts, which share one context, because they only count
+    characters in it. Objects with nested values fall back to
+    the usual layout, reusing values which were taken already.
+    """
+    compiling = current_context.get() is None and (
+        options is None or not (options.limited or options.references))
+    shared = Context(options or DEFAULT_OPTIONS) if compiling else None
+
+    plans = {}
+    for value in values:
+        cls = type(value)
+        plan = plans.get(cls)
+        if plan is None:
+            plan = plans[cls] = class_plan(value, options, compiling)
+        width, compiled, beginning = plan
+
+        if compiled is not None and instrumentation is None:
+            shared.width = width
+            node = compiled(value, shared, beginning)
+            if isinstance(node, Composite):
+                node = format_with(build_current, node, options, width)
+        else:
+            node = format_with(layout_top_value, value, options, width)
+
+        yield render(node, width)
+
+
+def format_batch(values, options):
+    return list(iter_formatted(values, options))
+
+
+def batches(values, size):
+    values = iter(values)
+    while True:
+        batch = list(islice(values, size))
+        if not batch:
+            return
+        yield batch
+
+
+def default_workers():
+    """Returns number of threads which make formatting faster:
+    one per CPU if Python runs without the GIL, otherwise one."""
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    if is_gil_enabled is not None and not is_gil_enabled():
+        import os
+        return os.cpu_count() or 1
+    return 1
+
+
+def format_many(values, stream=None, encoding=None, workers=None,
+                processes=False, batch_size=1000, **options):
+    """Formats each of the values like ``repr`` does.
+
+    Returns a list of representations, or writes them into
+    the file-like ``stream``, one per line. Binary streams get the text
+    encoded like :func:`write_repr` does.
+
+    Keyword arguments are parsed once for all values, limits
+    described in :class:`Options` apply to each value separately.
+
+    Values are split into batches of ``batch_size`` and formatted by
+    a pool of ``workers`` threads, or processes if ``processes`` is true.
+    Values and options should be picklable for processes, so
+    a :class:`Memo` can't be used with them. By default, threads are used
+    only on Python without the GIL, because otherwise they don't make
+    formatting faster, and there is one process per CPU.
+    """
+    options = Options(**options) if options else None
+
+    if workers is None:
+        if processes:
+            import os
+            workers = os.cpu_count() or 1
+        else:
+            workers = default_workers()
+
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+        pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        with pool(workers) as executor:
+            texts = list(chain.from_iterable(executor.map(
+                format_batch, batches(values, batch_size),
+                repeat(options))))
+    else:
+        texts = iter_formatted(values, options)
+
+    if stream is None:
+        return list(texts)
+
+    if encoding is None and \
+       isinstance(stream, (io.RawIOBase, io.BufferedIOBase)):
+        encoding = 'utf-8'
+
+    for text in texts:
+        text += u'\n'
+        if encoding is not None:
+            text = text.encode(encoding)
+        stream.write(text)
+
+
+def undercored(name):
+    return name.startswith('_')
+
+
+def is_always_callable(value):
+    """Checks if an attribute found in the class will be
+    callable when it is accessed through the instance.
+
+    Functions become bound methods, classmethods and staticmethods
+    return callables too. Other descriptors, like properties,
+    can return anything, so they are not treated as callables.
+    """
+    if isinstance(value, (types.FunctionType, staticmethod, classmethod)):
+        return True
+    return callable(value) and not hasattr(type(value), '__get__')
+
+
+def build_field_plan(cls, instance_keys, properties=None):
+    """Returns sorted names of attributes which can be shown
+    by the automatic ``__repr__``.
+
+    Attributes of the class are classified without calling them:
+    slots and plain values are shown, while properties and other
+    descriptors, which can load data lazily, are shown only if their
+    names are listed in ``properties``. If ``properties`` is ``True``,
+    all attributes of the class which are not methods are shown.
+
+    Values still should be checked when they are fetched,
+    because instance attributes and properties can hold callables too.
+    """
+    instance_keys = set(instance_keys)
+    names = set(name for name in instance_keys
+                if not undercored(name))
+    seen = set()
+
+    for klass in cls.__mro__:
+        for name, value in vars(klass).items():
+            if name in seen:
+                continue
+            # only the first class in the MRO defines the attribute
+            seen.add(name)
+
+            if undercored(name) or name in instance_keys:
+                continue
+
+            if properties is True:
+                if not is_always_callable(value):
+                    names.add(name)
+            elif isinstance(value, types.MemberDescriptorType) \
+                    or not is_descriptor(value) and not callable(value):
+                names.add(name)
+
+    if properties is not None and properties is not True:
+        names.update(properties)
+
+    return sorted(names)
+
+
+def slot_names(cls):
+    """Returns names of slots of the class and its bases or ``None``
+    if instances of the class have a ``__dict__``."""
+    names = []
+    for klass in reversed(cls.__mro__):
+        if klass is object:
+            continue
+
+        slots = vars(klass).get('__slots__')
+        if slots is None:
+            return None
+        if isinstance(slots, str):
+            slots = (slots,)
+
+        for name in slots:
+            if name == '__dict__':
+                return None
+            names.append(name)
+    return names
+
+
+def declared_fields(cls):
+    """Returns names of fields declared by a dataclass, an attrs class,
+    a named tuple or by ``__slots__``, in the order of declaration.
+    Returns ``None`` if instances can have any attributes.
+
+    Fields excluded from reprs of dataclasses and attrs classes
+    are excluded here too.
+    """
+    vars_of_cls = vars(cls)
+
+    fields = loaded('dataclasses', 'fields')
+    if fields is not None and '__dataclass_fields__' in vars_of_cls:
+        names = [field.name for field in fields(cls) if field.repr]
+    elif '__attrs_attrs__' in vars_of_cls:
+        names = [attribute.name for attribute in cls.__attrs_attrs__
+                 if attribute.repr is not False]
+    elif issubclass(cls, tuple) and hasattr(cls, '_fields'):
+        names = cls._fields
+    else:
+        names = slot_names(cls)
+
+    if names is None:
+        return None
+    return [name for name in names if not undercored(name)]
+
+
+class FieldPlans(object):
+    """Field plans of the class, one per instance's ``__dict__`` shape.
+
+    If the class declares it's fields, there is only one plan
+    with the ``declared`` fields.
+
+    Plans are valid as long as class and its bases stay the same,
+    which is checked by comparing their dicts with the snapshots
+    taken when the cache was created.
+    """
+    __slots__ = ('mro', 'snapshots', 'plans', 'declared')
+
+    attribute = '_magic_repr_plans'
+    max_plans = 64
+
+    def __init__(self, cls):
+        self.mro = cls.__mro__
+        self.plans = {}
+        self.declared = declared_fields(cls)
+
+        # cache is stored in the class itself, so it should
+        # be there before class's snapshot will be taken
+        setattr(cls, self.attribute, self)
+
+        self.snapshots = [dict(vars(klass))
+                          for klass in self.mro
+                          if klass is not object]
+
+    def is_valid(self, cls):
+        if cls.__mro__ != self.mro:
+            return False
+
+        classes = (klass for klass in self.mro
+                   if klass is not object)
+        try:
+            return all(vars(klass) == snapshot
+                       for klass, snapshot in zip(classes, self.snapshots))
+        except Exception:
+            # some attribute was replaced with
+            # an object which can't be compared
+            return False
+
+    def get(self, cls, instance_keys, properties=None):
+        """Returns names of fields and a flag telling
+        if they are declared fields."""
+        if self.declared is not None:
+            return self.declared, True
+
+        key = instance_keys, properties
+        plan = self.plans.get(key)
+
+        if plan is None:
+            if len(self.plans) >= self.max_plans:
+                self.plans.clear()
+
+            plan = build_field_plan(cls, instance_keys, properties)
+            self.plans[key] = plan
+
+        return plan, False
+
+
+DEFAULT_DIR = getattr(object, '__dir__', None)
+
+
+def is_descriptor(value):
+    """Tells if the class attribute would be computed on access,
+    the check does not look at the instance's attributes."""
+    return hasattr(type(value), '__get__')
+
+
+def get_field_plan(obj, properties=None):
+    """Returns names of attributes for the automatic ``__repr__``
+    and a flag telling if they are declared by the class.
+
+    Declared fields are taken from the class's declarations.
+    Other names are discovered once per class and per set of keys
+    in the object's ``__dict__``, see :func:`build_field_plan`.
+    When all attributes are requested with ``properties=True``,
+    objects which override ``__dir__`` or pretend to be
+    of another class are inspected using ``dir`` each time.
+    """
+    cls = type(obj)
+    instance_dict = get_instance_dict(obj)
+
+    if properties is True \
+       and (getattr(cls, '__dir__', None) is not DEFAULT_DIR
+            or obj.__class__ is not cls
+            or instance_dict is None):
+        return sorted(name for name in dir(obj)
+                      if not undercored(name)), False
+
+    if instance_dict is None:
+        instance_dict = {}
+
+    plans = vars(cls).get(FieldPlans.attribute)
+
+    if plans is None or not plans.is_valid(cls):
+        try:
+            plans = FieldPlans(cls)
+        except (TypeError, AttributeError):
+            # class does not allow to set attributes
+            declared = declared_fields(cls)
+            if declared is not None:
+                return declared, True
+            return build_field_plan(cls, instance_dict, properties), False
+
+    return plans.get(cls, tuple(instance_dict), properties)
+
+
+def read_attribute(instance_dict, obj, name, default):
+    """Returns value of the attribute, taking it from
+    the object's ``__dict__`` if it is there, so that descriptors
+    of the class with the same name are not called."""
+    value = instance_dict.get(name, MISSING)
+    if value is MISSING:
+        return getattr(obj, name, default)
+    return value
+
+
+def get_instance_dict(obj):
+    """Returns the object's ``__dict__`` without calling
+    properties, or ``None`` if it has no usable one."""
     try:
-        if isinstance(value, six.binary_type):
-            # suppose, all byte strings are in unicode
-            # don't know if everybody in the world uses anything else?
-            return u"'{0}'".format(value.decode('utf-8'))
-
-        elif isinstance(value, six.text_type):
-            return u"u'{0}'".format(value)
-
-        elif isinstance(value, (list, tuple)):
-            # long lists or lists with multiline items
-            # will be shown vertically
-            values = list(map(format_value, value))
-            result = serialize_list(u'[', values, delimiter=u',') + u']'
-            return force_unicode(result)
-
-        elif isinstance(value, dict):
-            items = six.iteritems(value)
-
-            # format each key/value pair as a text,
-            # calling format_value recursively
-            items = (tuple(map(format_value, item))
-                     for item in items)
-
-            items = list(items)
-            # sort by keys for readability
-            items.sort()
-
-            # for each item value
-            items = [
-                serialize_text(
-                    u'{0}: '.format(key),
-                    item_value)
-                for key, item_value in items]
-
-            # and serialize these pieces as a list, enclosing
-            # them into a curve brackets
-            result = serialize_list(u'{', items, delimiter=u',') + u'}'
-            return force_unicode(result)
-        return force_unicode(repr(value))
+        instance_dict = object.__getattribute__(obj, '__dict__')
+    except (AttributeError, TypeError):
+        return None
+    if isinstance(instance_dict, dict):
+        return instance_dict
+    return None
+
+
+def is_attribute_path(name):
+    """Checks if name like ``foo`` or ``foo.bar`` can be
+    put into the Python source as an attribute access."""
+    from keyword import iskeyword
+
+    parts = name.split('.')
+    return all(part and not iskeyword(part) and
+               (part[0].isalpha() or part[0] == '_') and
+               part.replace('_', 'a').isalnum()
+               for part in parts)
+
+
+def leaf_text(value):
+    """Returns the text of an atom or a one line string, which is
+    the same as it's layout, or ``None`` for other values."""
+    cls = type(value)
+    if cls in registry.atoms:
+        return repr(value)
+    if cls is str and u'\n' not in value \
+       and registry.dispatch(str) is describe_text:
+        return u"u'{0}'".format(value)
+    return None
+
+
+def layout_texts(context, beginning, texts):
+    """Makes layout of the object from texts of it's fields,
+    which are one line ``name=value`` texts."""
+    length = 0
+    for text in texts:
+        length += len(text)
+    context.chars += length
+
+    if context.width is None and length <= MAX_LENGTH:
+        return Text(beginning + u' '.join(texts) + u'>')
+
+    return Concat(Text(beginning),
+                  Group([Text(text) for text in texts]),
+                  Text(u'>'))
+
+
+def compile_layout(field_names, getters, options=None):
+    """Generates a layout function for the given fields.
+
+    Resulting function accesses attributes directly, and formats
+    atoms and strings right away, joining them with prefixes
+    created once, here. If some of the values are other objects
+    or containers, the function returns :class:`Composite` of the
+    values it took, and they are laid out as usual.
+
+    ``getters`` is a list of pairs ``(name, callable)``, their values
+    are shown after the fields from ``field_names``.
+
+    Resulting function is called as ``layout(self, context)``, or
+    as ``layout(self, context, beginning)`` where ``beginning`` is
+    the text which starts representation of the object, like
+    ``u'<Foo '``, if it is made once for the class by the caller.
+
+    Resulting function takes all fields at once, so it
+    should not be used when budgets are checked.
+    """
+    namespace = {
+        'Composite': Composite,
+        'leaf_text': leaf_text,
+        'layout_texts': layout_texts,
+        'options': options,
+    }
+    values = []
+    prefixes = []
+
+    for idx, name in enumerate(field_names):
+        prefixes.append(u'{0}='.format(name))
+
+        if is_attribute_path(name):
+            values.append('self.' + name)
+        else:
+            getter = 'getter_{0}'.format(idx)
+            namespace[getter] = attrgetter(name)
+            values.append(getter + '(self)')
+
+    for idx, (name, getter) in enumerate(getters, len(field_names)):
+        prefixes.append(u'{0}='.format(name))
+        namespace['getter_{0}'.format(idx)] = getter
+        values.append('getter_{0}(self)'.format(idx))
+
+    namespace['prefixes'] = [Text(prefix) for prefix in prefixes]
+
+    lines = ['def layout(self, context, beginning=None):']
+    lines.extend('    value_{0} = {1}'.format(idx, value)
+                 for idx, value in enumerate(values))
+    lines.extend([
+        '    if beginning is None:',
+        "        beginning = u'<' + self.__class__.__name__ + u' '",
+    ])
+
+    for idx in range(len(values)):
+        lines.extend([
+            '    text_{0} = leaf_text(value_{0})'.format(idx),
+            '    if text_{0} is None:'.format(idx),
+            '        return Composite(beginning, zip(prefixes, [{0}]), '
+            "u'>',".format(', '.join('value_{0}'.format(idx)
+                                     for idx in range(len(values)))),
+            '                         count={0}, limit_items=False, '
+            'options=options)'.format(len(values)),
+        ])
+
+    lines.append('    return layout_texts(context, beginning, [{0}])'.format(
+        ', '.join('{0!r} + text_{1}'.format(prefix, idx)
+                  for idx, prefix in enumerate(prefixes))))
+
+    source = '\n'.join(lines) + '\n'
+    code = compile(source, '<magic_repr layout>', 'exec')
+    exec(code, namespace)
+
+    layout = namespace['layout']
+    layout.source = source
+    return layout
+
+
+class Instrumentation(object):
+    """Timing and counters of ``__repr__`` methods made by ``make_repr``.
+
+    For each class it collects how many times its instances were
+    formatted, how long it took, including nested values, and how many
+    characters were produced. For each field it collects how many times
+    its getter was called and how long it took. Automatic discovery
+    of fields is timed separately.
+
+    ``hook``, if given, is called after each formatted object as
+    ``hook(class_name, seconds, chars, timings)``, where ``timings`` are
+    pairs ``(field_name, seconds)`` and field name is ``None`` for the
+    discovery.
+    """
 
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.lock = _thread.allocate_lock()
+        self.classes = {}
+
+    def record(self, cls, seconds, chars, timings):
+        name = u'{0}.{1}'.format(cls.__module__, cls.__name__)
+
+        with self.lock:
+            stats = self.classes.get(name)
+            if stats is None:
+                stats = self.classes[name] = dict(
+                    calls=0, time=0.0, chars=0,
+                    discovery=0.0, fields={})
+
+            stats['calls'] += 1
+            stats['time'] += seconds
+            stats['chars'] += chars
+
+            fields = stats['fields']
+            for field, field_seconds in timings:
+                if field is None:
+                    stats['discovery'] += field_seconds
+                    continue
+
+                field_stats = fields.get(field)
+                if field_stats is None:
+                    field_stats = fields[field] = dict(calls=0, time=0.0)
+                field_stats['calls'] += 1
+                field_stats['time'] += field_seconds
+
+        if self.hook is not None:
+            self.hook(name, seconds, chars, timings)
+
+    def snapshot(self):
+        """Returns collected stats as a dict, where keys
+        are full names of classes."""
+        with self.lock:
+            return dict(
+                (name, dict(stats,
+                            fields=dict((field, dict(field_stats))
+                                        for field, field_stats
+                                        in stats['fields'].items())))
+                for name, stats in self.classes.items())
+
+    def reset(self):
+        with self.lock:
+            self.classes.clear()
+
+
+# active instrumentation, if any
+instrumentation = None
+
+
+def instrument(hook=None):
+    """Starts collecting timing of ``__repr__`` methods made by
+    ``make_repr`` and returns :class:`Instrumentation` with the stats.
+
+    Until then, methods are not slowed down by measurements at all.
+    """
+    global instrumentation
+    instrumentation = Instrumentation(hook)
+    return instrumentation
+
+
+def stop_instrumenting():
+    global instrumentation
+    instrumentation = None
+
+
+def timed(timings, name, func, *args):
+    """Calls the function and appends its duration to ``timings``."""
+    started = perf_counter()
+    try:
+        return func(*args)
     finally:
-        recursion_breaker.processed.remove(value_id)
+        timings.append((name, perf_counter() - started))
+
+
+def pop_options(kwargs):
+    """Takes options from keyword arguments of ``make_repr``.
+
+    Returns :class:`Options` or ``None`` if there were no options.
+    """
+    options = dict((name, pop_option(kwargs, name))
+                   for name in Options.names)
+    options = dict((name, value)
+                   for name, value in options.items()
+                   if value is not None)
+    return Options(**options) if options else None
+
+
+def pop_option(kwargs, name, default=None):
+    """Takes an option from keyword arguments of ``make_repr``.
+
+    Keyword arguments with callables are field getters,
+    so a keyword is treated as an option only when
+    it's value is not callable.
+    """
+    value = kwargs.get(name)
+    if value is None or callable(value):
+        return default
+    return kwargs.pop(name)
 
 
 def make_repr(*args, **kwargs):
@@ -196,60 +2864,189 @@ def make_repr(*args, **kwargs):
 
       __repr__ = make_repr(foo=lambda obj: obj.blah + 100500)
 
-    """
-
-    def method(self):
-        cls_name = self.__class__.__name__
-
-        if args:
-            field_names = args
-        else:
-            def undercored(name): return name.startswith('_')
-
-            def is_method(name): return callable(getattr(self, name))
-
-            def good_name(name):
-                return not undercored(name) and not is_method(name)
+    When fields are given explicitly, ``compile=True`` makes
+    ``make_repr`` generate a specialized Python function for them,
+    which is faster than the generic one::
 
-            field_names = filter(good_name, dir(self))
-            field_names = sorted(field_names)
+      __repr__ = make_repr('foo', 'bar', compile=True)
 
-        # on this stage, we make from field_names an
-        # attribute getters
-        field_getters = zip(field_names,
-                            map(attrgetter, field_names))
+    Limits from :class:`Options` can be given as keyword arguments
+    too, they are applied to the object and everything inside it::
 
-        # now process keyword args, they must
-        # contain callables of one argument
-        # and callable should return a field's value
-        field_getters = chain(
-            field_getters,
-            kwargs.items())
+      __repr__ = make_repr('foo', 'bar', max_items=10, max_depth=2)
 
-        fields = ((name, format_value(getter(self)))
-                  for name, getter in field_getters)
-
-        # prepare key strings
-        fields = ((u'{0}='.format(name), value)
-                  for name, value in fields)
-
-        # join values with they respective keys
-        fields = list(starmap(serialize_text, fields))
+    """
+    compiled = pop_option(kwargs, 'compile', False)
+    cached = pop_option(kwargs, 'cache', False)
+    properties = pop_option(kwargs, 'properties')
+    if not properties:
+        properties = None
+    elif isinstance(properties, str):
+        properties = (properties,)
+    elif properties is not True:
+        try:
+            properties = tuple(properties)
+        except TypeError:
+            raise ValueError(
+                'properties should be True or names of properties, '
+                'not {0!r}'.format(properties))
+    options = pop_options(kwargs)
+
+    # on this stage, we make from field_names an
+    # attribute getters with prefixes
+    field_getters = [(Text(u'{0}='.format(name)), attrgetter(name))
+                     for name in args]
+
+    # now process keyword args, they must
+    # contain callables of one argument
+    # and callable should return a field's value
+    keyword_getters = [(Text(u'{0}='.format(name)), getter)
+                       for name, getter in kwargs.items()]
+
+    def automatic_fields(self, timings=None):
+        if timings is None:
+            names, declared = get_field_plan(self, properties)
+        else:
+            names, declared = timed(timings, None, get_field_plan,
+                                    self, properties)
 
+        if properties is True:
+            read = getattr
+        else:
+            instance_dict = get_instance_dict(self) or {}
+
+            def read(obj, name, default):
+                return read_attribute(instance_dict, obj, name, default)
+
+        for name in names:
+            if timings is None:
+                value = read(self, name, MISSING)
+            else:
+                value = timed(timings, name, read, self, name, MISSING)
+
+            if value is MISSING:
+                # slot without a value
+                continue
+
+            # instance attributes and properties
+            # can contain callables too, but declared
+            # fields are data anyway
+            if declared or not callable(value):
+                yield Text(u'{0}='.format(name)), value
+
+    def fields_of(self, getters, timings=None):
+        if timings is None:
+            return ((prefix, getter(self))
+                    for prefix, getter in getters)
+
+        # prefixes are "name="
+        return ((prefix, timed(timings, prefix.text[:-1], getter, self))
+                for prefix, getter in getters)
+
+    def describe(self, timings=None):
+        """Describes the object, appending durations of
+        field getters to ``timings`` if they are given."""
         beginning = u'<{cls_name} '.format(
-            cls_name=cls_name,
+            cls_name=self.__class__.__name__,
         )
-        result = serialize_list(
-            beginning,
-            fields)
+
+        if args:
+            count = len(field_getters) + len(keyword_getters)
+            fields = fields_of(self, field_getters, timings)
+        else:
+            fields = automatic_fields(self, timings)
+            count = None
+
+        # getters are called only when their values are
+        # requested, this way they are not called at all
+        # when budgets are exhausted
+        fields = chain(
+            fields,
+            fields_of(self, keyword_getters, timings))
 
         # append closing braket
-        result += u'>'
+        return Composite(beginning, fields, u'>',
+                         count=count, limit_items=False,
+                         options=options)
+
+    # explicit fields can be compiled into a layout function
+    fields = None
+    if (args or kwargs) and (options is None or not options.limited):
+        fields = args, list(kwargs.items())
+
+    compiled_layout = None
+    if compiled and fields is not None:
+        compiled_layout = compile_layout(fields[0], fields[1], options)
+
+    def instrumented_describe(self, instrumentation):
+        timings = []
+        started = perf_counter()
+
+        def finish(chars):
+            instrumentation.record(self.__class__,
+                                   perf_counter() - started,
+                                   chars, timings)
+
+        composite = describe(self, timings)
+        composite.finish = finish
+        return composite
+
+    def describe_for_layout(self):
+        # it can be stopped by another thread meanwhile
+        active = instrumentation
+        if active is not None:
+            return instrumented_describe(self, active)
+        return describe(self)
+
+    describe_for_layout.options = options
+    describe_for_layout.compiled = compiled_layout
+    describe_for_layout.fields = fields
+    # compiled by format_many, if make_repr didn't compile the layout
+    describe_for_layout.batch_compiled = None
+    width = options.width if options is not None else None
+
+    def layout(self):
+        context = current_context.get()
+        described = describe_object(context, self, describe_for_layout)
+        if isinstance(described, Composite):
+            return build(context, described)
+        return described
 
-        if ON_PYTHON2:
-            # on python 2.x repr returns bytes, but on python3 - unicode strings
-            result = result.encode('utf-8')
+    def method(self):
+        return render(format_with(layout, self, width=width), width)
 
-        return result
+    cache = None
+    if cached and (options is None or options.deadline_ms is None):
+        # keyword getters can read any attribute
+        if args and not kwargs:
+            cache = ReprCache(frozenset(name.split('.')[0] for name in args))
+        else:
+            cache = ReprCache()
+
+        render_method = method
+
+        def method(self):
+            # inside of another formatting call, the output depends
+            # on it's options and budgets, and instrumentation should
+            # see all calls
+            if current_context.get() is not None \
+               or instrumentation is not None:
+                return render_method(self)
+
+            text = cache.get(self)
+            if text is None:
+                entry = cache.reserve(self)
+                text = render_method(self)
+                if entry is not None:
+                    cache.put(self, entry, text)
+            return text
+
+    # this way layout_value is able to include object's
+    # layout into the layout of a container without
+    # rendering it to a string first
+    method.magic_repr_layout = layout
+    method.magic_repr_describe = describe_for_layout
+    method.magic_repr_compiled = compiled_layout
+    method.magic_repr_cache = cache
 
     return method
@@ -0,0 +1,82 @@
+# coding: utf-8
+"""Formatting of NumPy arrays.
+
+Arrays are summarized instead of being converted to text entirely::
+
+  <ndarray shape=(1000000,)
+           dtype=int64
+           min=0
+           max=999999
+           mean=499999.5
+           data=[     0,      1,      2, ..., 999997, 999998, 999999]>
+
+Only a few elements from the head and the tail are converted to text,
+summary is calculated by NumPy without making Python objects.
+
+This module is imported automatically when the first array is formatted,
+so NumPy is never imported by ``magic_repr`` itself.
+"""
+
+import numpy
+
+from magic_repr import Composite, Text, layout_leaf, registry
+
+
+EDGE_ITEMS = 3
+
+SHAPE = Text(u'shape=')
+DTYPE = Text(u'dtype=')
+MIN = Text(u'min=')
+MAX = Text(u'max=')
+MEAN = Text(u'mean=')
+DATA = Text(u'data=')
+
+
+class Raw(object):
+    """Text which is shown as is."""
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+
+def describe_raw(context, value):
+    return layout_leaf(context, value.text)
+
+
+def has_summary(value):
+    return value.size > 0 and (
+        numpy.issubdtype(value.dtype, numpy.integer) or
+        numpy.issubdtype(value.dtype, numpy.floating))
+
+
+def array_entries(context, value):
+    yield SHAPE, Raw(repr(value.shape))
+    yield DTYPE, Raw(str(value.dtype))
+
+    if has_summary(value):
+        yield MIN, Raw(str(value.min()))
+        yield MAX, Raw(str(value.max()))
+        yield MEAN, Raw(str(value.mean()))
+
+    edge_items = EDGE_ITEMS
+    max_items = context.options.max_items
+    if max_items is not None:
+        edge_items = max(1, max_items // 2)
+
+    # numpy summarizes arrays with more than threshold elements
+    data = numpy.array2string(value,
+                              separator=u', ',
+                              threshold=edge_items * 2,
+                              edgeitems=edge_items)
+    yield DATA, Raw(data)
+
+
+def describe_array(context, value):
+    beginning = u'<{0} '.format(type(value).__name__)
+    return Composite(beginning, array_entries(context, value), u'>',
+                     limit_items=False)
+
+
+registry.register(Raw, describe_raw)
+registry.register_default(numpy.ndarray, describe_array)
@@ -0,0 +1,304 @@
+# coding: utf-8
+"""Benchmarks for ``magic_repr``.
+
+Run them with::
+
+    python -m magic_repr.bench
+
+Each scenario reports operations per second, latency percentiles
+and peak memory of one call. Results can be saved as a baseline
+and compared with it later, for example before and after a release::
+
+    python -m magic_repr.bench --save before.json
+    python -m magic_repr.bench --compare before.json
+
+Scenarios with containers are measured with ``pprint`` and ``reprlib``
+from the standard library too. Time of ``import magic_repr`` is measured
+in fresh interpreters.
+"""
+
+import argparse
+import json
+import pprint
+import reprlib
+import subprocess
+import sys
+import threading
+import timeit
+import tracemalloc
+
+from magic_repr import format_bytes, format_many, format_value, make_repr
+
+
+# number of interpreters started to measure import time
+IMPORTS = 20
+
+FIELDS = ['field_{0}'.format(idx) for idx in range(10)]
+
+
+def make_class(fields=FIELDS, automatic=False, slots=False, **options):
+    class Model(object):
+        if slots:
+            __slots__ = fields
+
+        def __init__(self):
+            for idx, name in enumerate(fields):
+                setattr(self, name, idx)
+
+        if automatic:
+            __repr__ = make_repr(**options)
+        else:
+            __repr__ = make_repr(*fields, **options)
+
+    return Model
+
+
+def make_order():
+    class Order(object):
+        def __init__(self):
+            self.id = 1
+            self.name = 'name'
+            self.lines = [1, 2, 3]
+            self.extra = {'x': 1, 'y': 2}
+
+        __repr__ = make_repr('id', 'name', 'lines', 'extra')
+
+    return Order()
+
+
+def make_deep(depth=100):
+    class Node(object):
+        def __init__(self, child):
+            self.child = child
+
+        __repr__ = make_repr('child')
+
+    node = None
+    for idx in range(depth):
+        node = Node(node)
+    return node
+
+
+def make_cyclic(size=100):
+    class Vertex(object):
+        def __init__(self, idx):
+            self.idx = idx
+            self.links = []
+
+        __repr__ = make_repr('idx', 'links')
+
+    # a ring where each vertex links to the next and the previous one,
+    # so every vertex is shown once and links back are cut
+    vertices = [Vertex(idx) for idx in range(size)]
+    for idx, vertex in enumerate(vertices):
+        vertex.links.append(vertices[(idx + 1) % size])
+        vertex.links.append(vertices[idx - 1])
+    return vertices[0]
+
+
+def latencies(func, number):
+    """Returns sorted durations of ``number`` calls."""
+    timer = timeit.default_timer
+    result = []
+    for idx in range(number):
+        started = timer()
+        func()
+        result.append(timer() - started)
+    result.sort()
+    return result
+
+
+def percentile(values, fraction):
+    """Returns percentile of sorted values."""
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def peak_memory(func):
+    """Returns peak memory in bytes allocated by one call."""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def in_threads(func, threads=4):
+    """Returns a function which calls ``func``
+    in several threads simultaneously."""
+    def run():
+        workers = [threading.Thread(target=func)
+                   for idx in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    return run
+
+
+def scenarios():
+    """Yields triples ``(name, function, number)``, where
+    ``number`` is how many times the function should be called."""
+    explicit = make_class()()
+    shallow_class = make_class(['a', 'b'])
+    shallow = shallow_class()
+    shallow_list = [shallow_class() for idx in range(30000)]
+    automatic = make_class(automatic=True)()
+    compiled = make_class(compile=True)()
+    cached = make_class(cache=True)()
+    slotted = make_class(automatic=True, slots=True)()
+    wide = make_class(['field_{0}'.format(idx) for idx in range(200)],
+                      automatic=True)()
+    deep = make_deep()
+    cyclic = make_cyclic()
+    long_list = list(range(10000))
+    big_dict = dict(('key_{0}'.format(idx), idx) for idx in range(10000))
+    nested = [dict(id=idx, tags=['a', 'b'], size=(idx, idx))
+              for idx in range(1000)]
+    small_dicts = [dict(id=idx, name='name_{0}'.format(idx), tags=['a', 'b'])
+                   for idx in range(2000)]
+    order = make_order()
+    record_class = make_class()
+    records = [record_class() for idx in range(1000)]
+
+    yield 'explicit fields', lambda: repr(explicit), 10000
+    yield 'shallow object', lambda: repr(shallow), 10000
+    yield 'list of shallow objects', lambda: format_value(shallow_list), 5
+    yield 'automatic fields', lambda: repr(automatic), 10000
+    yield 'compiled fields', lambda: repr(compiled), 10000
+    yield 'cached fields', lambda: repr(cached), 10000
+    yield 'slotted fields', lambda: repr(slotted), 10000
+    yield 'wide object', lambda: repr(wide), 200
+    yield 'object with containers', lambda: repr(order), 10000
+    yield 'nested small containers', lambda: format_value(small_dicts), 20
+    yield 'deep nesting', lambda: repr(deep), 500
+    yield 'recursive links', lambda: repr(cyclic), 20
+    yield 'threads', in_threads(lambda: [repr(explicit)
+                                         for idx in range(100)]), 50
+    yield 'many objects', lambda: format_many(records), 20
+    yield 'many objects / repr', lambda: [repr(record)
+                                          for record in records], 20
+    yield 'list of objects', lambda: format_value(records), 20
+    yield 'big output / bytes', lambda: format_bytes(nested), 10
+    yield 'big output / encode', \
+        lambda: format_value(nested).encode('utf-8'), 10
+    yield 'list of objects / table', \
+        lambda: format_value(records, table=True), 20
+
+    for name, value, number in (('long list', long_list, 20),
+                                ('big dict', big_dict, 10),
+                                ('nested containers', nested, 10)):
+        yield name, lambda value=value: format_value(value), number
+        yield name + ' / width 80', \
+            lambda value=value: format_value(value, width=80), number
+        yield name + ' / pprint', \
+            lambda value=value: pprint.pformat(value), number
+        yield name + ' / reprlib', \
+            lambda value=value: reprlib.repr(value), number
+
+
+def python(code):
+    """Runs code in a fresh interpreter and returns
+    it's stdout and stderr."""
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True, check=True)
+    return process.stdout, process.stderr
+
+
+def import_time(module='magic_repr'):
+    """Returns time in seconds of importing the module
+    together with modules it imports."""
+    stdout, stderr = python('import ' + module)
+    # lines look like "import time: self [us] | cumulative | package"
+    for line in stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[2].strip() == module:
+            return int(parts[1]) / 1e6
+    raise RuntimeError('Import time of {0} is unknown'.format(module))
+
+
+def imported_modules(module='magic_repr'):
+    """Returns sorted names of modules imported by the module,
+    which were not imported on the interpreter's start."""
+    stdout, stderr = python(
+        'import sys; started = set(sys.modules); import {0}; '
+        'print(" ".join(sorted(set(sys.modules) - started)))'.format(module))
+    return stdout.split()
+
+
+def summarize(durations, memory=None):
+    durations = sorted(durations)
+    return dict(ops=len(durations) / sum(durations),
+                p50=percentile(durations, 0.5),
+                p90=percentile(durations, 0.9),
+                p99=percentile(durations, 0.99),
+                memory=memory)
+
+
+def run(func, number):
+    return summarize(latencies(func, number), peak_memory(func))
+
+
+def run_import(number):
+    return summarize(import_time() for idx in range(number))
+
+
+def format_result(name, result, baseline=None):
+    line = u'{0:32} {1:12.0f} {2:10.1f} {3:10.1f} {4:10.1f} {5:>10}'.format(
+        name,
+        result['ops'],
+        result['p50'] * 1e6,
+        result['p90'] * 1e6,
+        result['p99'] * 1e6,
+        u'-' if result['memory'] is None
+        else u'{0:.0f}K'.format(result['memory'] / 1024))
+
+    if baseline is not None and name in baseline:
+        line += u' {0:7.2f}x'.format(result['ops'] / baseline[name]['ops'])
+    return line
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--save', metavar='PATH',
+                        help='save results as a baseline')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='compare results with a saved baseline')
+    parser.add_argument('--only', metavar='TEXT',
+                        help='run scenarios with this text in names')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply numbers of calls by this')
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print(u'{0:32} {1:>12} {2:>10} {3:>10} {4:>10} {5:>10}{6}'.format(
+        u'scenario', u'ops/sec', u'p50, us', u'p90, us', u'p99, us',
+        u'memory', u'   change' if baseline else u''))
+
+    results = {}
+    for name, func, number in scenarios():
+        if args.only and args.only not in name:
+            continue
+
+        result = run(func, max(1, int(number * args.scale)))
+        results[name] = result
+        print(format_result(name, result, baseline))
+
+    name = 'import'
+    if not args.only or args.only in name:
+        result = run_import(max(1, int(IMPORTS * args.scale)))
+        results[name] = result
+        print(format_result(name, result, baseline))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
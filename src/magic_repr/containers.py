@@ -0,0 +1,36 @@
+# coding: utf-8
+"""Formatting of containers from the ``collections`` module.
+
+This module is imported automatically when the first deque
+or ``OrderedDict`` is formatted, so programs which don't use them
+don't spend time on importing ``collections``.
+"""
+
+from collections import OrderedDict, deque
+
+from magic_repr import (Composite, insertion_entries, iter_entries,
+                        layout_leaf, registry)
+
+
+def describe_deque(context, value):
+    if value.maxlen is None:
+        closing = u'])'
+    else:
+        closing = u'], maxlen={0})'.format(value.maxlen)
+
+    return Composite(type(value).__name__ + u'([', iter_entries(value),
+                     closing, delimiter=u',', count=len(value))
+
+
+def describe_ordered_dict(context, value):
+    name = type(value).__name__
+    if not value:
+        return layout_leaf(context, name + u'()')
+
+    # order of items is meaningful here, so they are not sorted
+    return Composite(name + u'({', insertion_entries(context, value),
+                     u'})', delimiter=u',', count=len(value))
+
+
+registry.register_default(deque, describe_deque)
+registry.register_default(OrderedDict, describe_ordered_dict)
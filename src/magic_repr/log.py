@@ -0,0 +1,49 @@
+# coding: utf-8
+"""Integration with the standard ``logging`` module."""
+
+import logging
+
+from magic_repr import LazyRepr
+
+
+def has_magic_repr(value):
+    """Checks if ``str(value)`` gives a representation
+    made by ``make_repr``."""
+    cls = type(value)
+    return getattr(cls.__repr__, 'magic_repr_layout', None) is not None \
+        and cls.__str__ is object.__str__
+
+
+class LazyReprFilter(logging.Filter):
+    """Wraps arguments of log records into :class:`~magic_repr.LazyRepr`.
+
+    This way objects with ``__repr__`` made by ``make_repr`` are
+    formatted with given limits, only when a handler emits the record,
+    and only once, no matter how many handlers there are::
+
+      handler.addFilter(LazyReprFilter(max_items=10, max_chars=1000))
+
+    Only arguments which would be shown using their ``__repr__``
+    are wrapped, other are left as is.
+    """
+
+    def __init__(self, name='', **options):
+        super(LazyReprFilter, self).__init__(name)
+        self.options = options
+
+    def wrap(self, value):
+        if has_magic_repr(value):
+            return LazyRepr(value, **self.options)
+        return value
+
+    def filter(self, record):
+        if not super(LazyReprFilter, self).filter(record):
+            return False
+
+        args = record.args
+        if isinstance(args, tuple):
+            record.args = tuple(map(self.wrap, args))
+        elif isinstance(args, dict):
+            record.args = dict((key, self.wrap(value))
+                               for key, value in args.items())
+        return True
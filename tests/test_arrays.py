@@ -0,0 +1,52 @@
+# coding: utf-8
+
+from __future__ import division, absolute_import
+from __future__ import print_function
+
+from nose.plugins.skip import SkipTest
+from nose.tools import eq_
+from magic_repr import format_value, make_repr
+
+try:
+    import numpy
+except ImportError:
+    raise SkipTest('numpy is not installed')
+
+
+def test_array_is_summarized():
+    value = numpy.arange(1000000, dtype=numpy.int64)
+    eq_(format_value(value), u"""
+<ndarray shape=(1000000,)
+         dtype=int64
+         min=0
+         max=999999
+         mean=499999.5
+         data=[     0,      1,      2, ..., 999997, 999998, 999999]>
+"""[1:-1])
+
+
+def test_array_lines_are_aligned_inside_an_object():
+    class Foo(object):
+        def __init__(self):
+            self.data = numpy.array([[1, 2], [3, 4]], dtype=numpy.int8)
+
+        __repr__ = make_repr()
+
+    eq_(repr(Foo()), """
+<Foo data=<ndarray shape=(2, 2)
+                   dtype=int8
+                   min=1
+                   max=4
+                   mean=2.5
+                   data=[[1, 2],
+                         [3, 4]]>>
+"""[1:-1])
+
+
+def test_array_without_summary_respects_max_items():
+    value = numpy.array([u'a', u'b', u'c', u'd'])
+    eq_(format_value(value, max_items=2), u"""
+<ndarray shape=(4,)
+         dtype=<U1
+         data=['a', ..., 'd']>
+"""[1:-1])
@@ -0,0 +1,42 @@
+# coding: utf-8
+
+from __future__ import division, absolute_import
+from __future__ import print_function
+
+import json
+import os
+import tempfile
+
+from nose.tools import eq_
+from magic_repr import bench
+
+
+def test_results_are_saved_as_baseline():
+    handle, path = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    try:
+        bench.main(['--only', 'fields', '--scale', '0.001', '--save', path])
+        bench.main(['--only', 'fields', '--scale', '0.001', '--compare', path])
+
+        with open(path) as f:
+            results = json.load(f)
+    finally:
+        os.remove(path)
+
+    eq_(sorted(results),
+        ['automatic fields', 'cached fields', 'compiled fields',
+         'explicit fields', 'slotted fields'])
+    eq_(sorted(results['explicit fields']),
+        ['memory', 'ops', 'p50', 'p90', 'p99'])
+
+
+def test_import_does_not_load_optional_modules():
+    # these should be imported on first use
+    optional = set(['asyncio', 'collections', 'concurrent.futures', 'heapq',
+                    'numpy', 'threading', 'weakref',
+                    'magic_repr.arrays', 'magic_repr.containers'])
+    eq_(sorted(set(bench.imported_modules()) & optional), [])
+
+
+def test_import_time_is_measured():
+    assert bench.import_time() > 0
@@ -0,0 +1,76 @@
+# coding: utf-8
+
+from __future__ import division, absolute_import
+from __future__ import print_function
+
+import logging
+
+from nose.tools import eq_
+from magic_repr import lazy_repr, make_repr
+from magic_repr.log import LazyReprFilter
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+
+CALLS = []
+
+
+class Counted(object):
+    def __init__(self):
+        self._items = list(range(10))
+
+    def get_items(self):
+        CALLS.append(self)
+        return self._items
+
+    __repr__ = make_repr(items=get_items)
+
+
+def make_logger(name, *handlers):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    for handler in handlers:
+        logger.addHandler(handler)
+    return logger
+
+
+def test_lazy_repr_formats_only_once():
+    del CALLS[:]
+    value = lazy_repr(Counted(), max_items=2)
+    eq_(len(CALLS), 0)
+
+    eq_(str(value), '<Counted items=[0, 1, ...(8 more)]>')
+    eq_(str(value), '<Counted items=[0, 1, ...(8 more)]>')
+    eq_(len(CALLS), 1)
+
+
+def test_lazy_repr_is_not_formatted_for_disabled_level():
+    del CALLS[:]
+    handler = ListHandler()
+    logger = make_logger('magic_repr.tests.disabled', handler)
+
+    logger.debug('value=%s', lazy_repr(Counted()))
+    eq_(len(CALLS), 0)
+    eq_(handler.messages, [])
+
+
+def test_filter_wraps_arguments_for_all_handlers():
+    del CALLS[:]
+    first, second = ListHandler(), ListHandler()
+    logger = make_logger('magic_repr.tests.filter', first, second)
+    logger.addFilter(LazyReprFilter(max_items=1))
+
+    logger.info('value=%s number=%s', Counted(), 42)
+
+    expected = ['value=<Counted items=[0, ...(9 more)]> number=42']
+    eq_(first.messages, expected)
+    eq_(second.messages, expected)
+    eq_(len(CALLS), 1)
@@ -3,16 +3,31 @@
 from __future__ import division, absolute_import
 from __future__ import print_function
 
+import io
+import sys
 import threading
 
+from collections import OrderedDict, deque
+from nose.plugins.skip import SkipTest
 from nose.tools import eq_
 from magic_repr import (
+    arepr,
+    Memo,
     serialize_list,
     serialize_text,
+    stop_instrumenting,
     is_multiline,
+    format_bytes,
+    format_many,
     format_value,
+    instrument,
+    iter_repr,
     make_repr,
-    padding_adder)
+    padding_adder,
+    register_formatter,
+    registry,
+    timeouts,
+    write_repr)
 
 
 def test_automatic_builder_sorts_alphabetically():
@@ -521,3 +536,1185 @@ def test_repr_can_be_called_in_thread():
     eq_(exceptions, [])
     eq_(results[0],
         "<TestMe foo=u'bar'>")
+
+
+def test_deeply_nested_objects_are_padded_once():
+    class Node(object):
+        def __init__(self, name, child=None):
+            self.name = name
+            self.child = child
+
+        __repr__ = make_repr('child', 'name')
+
+    node = None
+    for idx in range(300):
+        node = Node(u'n{0}'.format(idx), node)
+
+    result = repr(node)
+    lines = result.split('\n')
+
+    # each level adds one line for the name
+    # and the next level is shifted by the prefix's width
+    eq_(len(lines), 300)
+    eq_(lines[0].startswith(u'<Node child=' * 299), True)
+    eq_(lines[-1], u"      name=u'n299'>")
+
+
+def test_depth_is_not_limited_by_recursion_limit():
+    class Node(object):
+        def __init__(self, child=None):
+            self.child = child
+
+        __repr__ = make_repr('child')
+
+    node = None
+    value = []
+    for idx in range(sys.getrecursionlimit() * 2):
+        node = Node(node)
+        value = [value, {1: []}] if idx % 100 == 0 else [value]
+
+    eq_(repr(node).count(u'<Node child='), sys.getrecursionlimit() * 2)
+    eq_(format_value(value).count(u'{1: '), sys.getrecursionlimit() // 50)
+    eq_(u''.join(iter_repr(node, chunk_size=100000)), repr(node))
+
+
+def test_state_is_restored_when_getter_fails():
+    class Broken(object):
+        __repr__ = make_repr(value=lambda obj: 1 // 0)
+
+    value = [[1, {2: Broken()}], 3]
+    for idx in range(2):
+        try:
+            format_value(value, max_depth=5)
+        except ZeroDivisionError:
+            pass
+        else:
+            raise AssertionError('ZeroDivisionError was not raised')
+
+    # lists are not considered as processed anymore
+    value[0][1] = 2
+    eq_(format_value(value), u'[[1, 2], 3]')
+
+
+def test_layout_tree_keeps_width_and_multiline_flags():
+    from magic_repr import Text, Concat, Group, render
+
+    row = Group([Text(u'a=1'), Text(u'b=2')])
+    eq_(row.multiline, False)
+    eq_(row.width, len(u'a=1 b=2'))
+
+    column = Concat(Text(u'<Foo '),
+                    Group([Text(u'a=1'), Text(u'b=\n2')]),
+                    Text(u'>'))
+    eq_(column.multiline, True)
+    eq_(render(column), u'<Foo a=1\n     b=\n     2>')
+
+
+def test_values_after_multiline_dict_keys_are_aligned_to_last_line():
+    value = {u'x\ny': {u'p': 1, u'q\nr': 2}}
+    eq_(format_value(value),
+        u"{u'x\n"
+        u" y': {u'p': 1,\n"
+        u"      u'q\n"
+        u"      r': 2}}")
+
+
+def test_values_shown_in_a_row_are_collapsed_into_texts():
+    from magic_repr import Text, layout_value
+
+    class Point(object):
+        def __init__(self, x, y):
+            self.x = x
+            self.y = y
+
+        __repr__ = make_repr('x', 'y')
+
+    # nodes are not kept for each field of small objects
+    node = layout_value([Point(1, 2), (3, 4)])
+    eq_([type(item) for item in node.parts[1].items], [Text, Text])
+    eq_(node.parts[1].items[0].text, u'<Point x=1 y=2>')
+
+    # but they are kept when output is fitted into a width,
+    # to be split into lines if needed
+    eq_(format_value([Point(1, 2)], width=10), u'[<Point x=1\n        y=2>]')
+
+
+def test_automatic_builder_caches_field_plan_per_class():
+    class TestMe(object):
+        def __init__(self):
+            self.foo = 1
+
+        __repr__ = make_repr()
+
+    instance = TestMe()
+    eq_(repr(instance), "<TestMe foo=1>")
+
+    # another instance with the same attributes reuses the plan
+    eq_(repr(TestMe()), "<TestMe foo=1>")
+    eq_(len(TestMe._magic_repr_plans.plans), 1)
+
+    # new instance attribute changes the shape of the __dict__
+    instance.bar = 2
+    eq_(repr(instance), "<TestMe bar=2 foo=1>")
+
+
+def test_automatic_builder_notices_class_mutation():
+    class TestMe(object):
+        def __init__(self):
+            self.foo = 1
+
+        def bar(self):
+            return 2
+
+        __repr__ = make_repr()
+
+    instance = TestMe()
+    eq_(repr(instance), "<TestMe foo=1>")
+
+    TestMe.blah = u'minor'
+    eq_(repr(instance), "<TestMe blah=u'minor' foo=1>")
+
+    # method was replaced with a plain value
+    TestMe.bar = 3
+    eq_(repr(instance), "<TestMe bar=3\n        blah=u'minor'\n        foo=1>")
+
+
+def test_automatic_builder_skips_callable_instance_attributes():
+    class TestMe(object):
+        def __init__(self, foo):
+            self.foo = foo
+
+        __repr__ = make_repr()
+
+    eq_(repr(TestMe(1)), "<TestMe foo=1>")
+    eq_(repr(TestMe(len)), "<TestMe >")
+
+
+def test_automatic_builder_uses_slots():
+    class Base(object):
+        __slots__ = ('foo', '_private', '__weakref__')
+
+    class TestMe(Base):
+        __slots__ = 'bar'
+
+        @property
+        def blah(self):
+            return 1
+
+        __repr__ = make_repr()
+
+    instance = TestMe()
+    instance.foo = 1
+    eq_(repr(instance), "<TestMe foo=1>")
+
+    instance.bar = len
+    eq_(repr(instance), "<TestMe foo=1\n        bar=<built-in function len>>")
+
+
+def test_automatic_builder_uses_dataclass_fields():
+    from dataclasses import dataclass, field
+
+    @dataclass
+    class TestMe:
+        foo: int
+        bar: int = field(default=0, repr=False)
+        blah: int = 2
+
+        @property
+        def minor(self):
+            return 3
+
+        __repr__ = make_repr()
+
+    eq_(repr(TestMe(1)), "<TestMe foo=1 blah=2>")
+
+
+def test_automatic_builder_uses_named_tuple_fields():
+    from typing import NamedTuple
+
+    class TestMe(NamedTuple):
+        foo: int
+        bar: int
+
+        __repr__ = make_repr()
+
+    eq_(repr(TestMe(2, 1)), "<TestMe foo=2 bar=1>")
+
+    # nested named tuple is shown by it's own __repr__,
+    # not as a tuple
+    value = [TestMe(2, 1)]
+    eq_(format_value(value), u"[<TestMe foo=2 bar=1>]")
+    eq_(u''.join(iter_repr(value)), u"[<TestMe foo=2 bar=1>]")
+    eq_(format_many(value), [u"<TestMe foo=2 bar=1>"])
+    eq_(format_value({u'point': TestMe(2, 1)}),
+        u"{u'point': <TestMe foo=2 bar=1>}")
+
+
+def test_automatic_builder_uses_attrs_fields():
+    try:
+        import attr
+    except ImportError:
+        raise SkipTest('attrs is not installed')
+
+    @attr.s(repr=False, slots=True)
+    class TestMe(object):
+        foo = attr.ib()
+        bar = attr.ib(repr=False)
+
+        __repr__ = make_repr()
+
+    eq_(repr(TestMe(1, 2)), "<TestMe foo=1>")
+
+
+def test_compiled_repr_is_same_as_generic():
+    class TestMe(object):
+        def __init__(self):
+            self.foo = u'фу'
+            self.bar = [1, 2, 3]
+            self.parent = None
+
+        def some_method(self):
+            return u'Минор'
+
+    generic = make_repr('foo', 'bar', 'bar.__len__', blah=TestMe.some_method)
+    compiled = make_repr('foo', 'bar', 'bar.__len__', blah=TestMe.some_method,
+                         compile=True)
+
+    instance = TestMe()
+    eq_(compiled(instance), generic(instance))
+    eq_(u'self.foo' in compiled.magic_repr_compiled.source, True)
+
+    # values which are not atoms or one line strings are laid out as usual
+    for foo in (1, u'a\nb', None, (1, 2), instance):
+        instance.foo = foo
+        eq_(compiled(instance), generic(instance))
+
+    instance.foo = 1
+    for options in ({}, dict(width=15), dict(references=True),
+                    dict(max_chars=5)):
+        TestMe.__repr__ = generic
+        expected = format_value([instance, 2], **options)
+        TestMe.__repr__ = compiled
+        eq_(format_value([instance, 2], **options), expected)
+
+
+def test_compile_can_be_a_name_of_generated_field():
+    class TestMe(object):
+        __repr__ = make_repr(compile=lambda obj: 1)
+
+    eq_(repr(TestMe()), "<TestMe compile=1>")
+
+
+def test_format_value_shows_only_max_items():
+    eq_(format_value(list(range(1000000)), max_items=3),
+        u'[0, 1, 2, ...(999997 more)]')
+
+    expected = u"""
+{1: u'a',
+ 2: u'b',
+ ...(1 more)}
+"""
+    eq_(format_value({1: u'a', 2: u'b', 3: u'c'}, max_items=2),
+        expected.strip())
+
+
+def test_format_value_cuts_long_strings():
+    eq_(format_value(u'фуубар', max_string=3),
+        u"u'фуу'...(3 more)")
+    eq_(format_value(u'фуубар'.encode('utf-8'), max_string=4),
+        u"'фу'...(8 more)")
+
+
+def test_format_value_hides_too_deep_values():
+    eq_(format_value([1, [2, [3]], {4: 5}], max_depth=1),
+        u'[1, [...], {...}]')
+
+
+def test_format_value_stops_when_out_of_chars():
+    # formatting stops after the item which exceeded the budget
+    expected = u"""
+[u'фуу',
+ u'бар',
+ ...(1 more)]
+"""
+    eq_(format_value([u'фуу', u'бар', u'базз'], max_chars=8),
+        expected.strip())
+
+
+def test_make_repr_accepts_limits():
+    calls = []
+
+    def expensive(obj):
+        calls.append(obj)
+        return 1
+
+    class TestMe(object):
+        def __init__(self):
+            self.foo = list(range(10))
+            self.bar = u'a' * 100
+
+    TestMe.__repr__ = make_repr('foo', 'bar', blah=expensive,
+                                max_items=2, max_chars=10)
+
+    expected = """
+<TestMe foo=[0, 1, ...(8 more)]
+        bar=u'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa'
+        ...(1 more)>
+"""
+    eq_(repr(TestMe()), expected.strip())
+    # getter was not called, because there was no budget for it's value
+    eq_(calls, [])
+
+
+def test_nested_object_limits_are_applied_to_its_fields():
+    class Child(object):
+        def __init__(self):
+            self.items = list(range(10))
+
+        __repr__ = make_repr('items', max_items=1)
+
+    class Parent(object):
+        def __init__(self):
+            self.items = list(range(3))
+            self.child = Child()
+
+        __repr__ = make_repr('items', 'child', compile=True)
+
+    expected = """
+<Parent items=[0, 1, 2]
+        child=<Child items=[0, ...(9 more)]>>
+"""
+    eq_(repr(Parent()), expected.strip())
+    expected = """
+<Parent items=[...]
+        child=<Child ...>>
+"""
+    eq_(format_value(Parent(), max_depth=1), expected.strip())
+
+
+def test_iter_repr_yields_same_text_by_chunks():
+    class Bar(object):
+        def __init__(self, idx):
+            self.first = idx
+            self.second = [idx] * idx
+            self.third = {u'три': idx}
+
+        __repr__ = make_repr()
+
+    class Foo(object):
+        def __init__(self):
+            self.bars = [Bar(idx) for idx in range(5)]
+            self.text = u'фуу\nбар'
+            self.empty = []
+
+        __repr__ = make_repr()
+
+    instance = Foo()
+    instance.parent = instance
+
+    expected = repr(instance)
+    chunks = list(iter_repr(instance, chunk_size=10))
+    eq_(u''.join(chunks), expected)
+    eq_(len(chunks) > 10, True)
+
+    value = [list(range(25)), {1: u'a'}, [[1], [2, [3]]]]
+    eq_(u''.join(iter_repr(value, chunk_size=1)), format_value(value))
+
+
+def test_iter_repr_respects_limits():
+    value = {u'a': list(range(100)), u'b': u'x' * 100}
+    for options in ({'max_items': 2}, {'max_chars': 10},
+                    {'max_depth': 1}, {'max_string': 3}):
+        eq_(u''.join(iter_repr(value, **options)),
+            format_value(value, **options))
+
+
+def test_write_repr_writes_text_or_bytes():
+    value = [u'фуу'] * 30
+
+    text_stream = io.StringIO()
+    write_repr(value, text_stream)
+    eq_(text_stream.getvalue(), format_value(value))
+
+    binary_stream = io.BytesIO()
+    write_repr(value, binary_stream)
+    eq_(binary_stream.getvalue(), format_value(value).encode('utf-8'))
+
+
+def test_memo_reuses_layouts_of_immutable_values():
+    memo = Memo()
+    value = [u'foo', (1, 2), u'foo', (1, 2), [3]]
+
+    eq_(format_value(value, memo=memo), format_value(value))
+    stats = memo.stats()
+    eq_(stats['hits'], 2)
+    # the list [3] is mutable and is not memoized, but 3 is
+    eq_(stats['size'], 5)
+
+    class Foo(object):
+        def __init__(self):
+            self.items = (u'foo', 1)
+
+        __repr__ = make_repr(memo=memo)
+
+    eq_(repr(Foo()), "<Foo items=[u'foo', 1]>")
+    # both items were formatted before
+    eq_(memo.stats()['hits'], 4)
+
+
+def test_memo_distinguishes_equal_values_of_different_types():
+    memo = Memo()
+    value = [1, True, 1.0, 0.0, -0.0, (1,), (True,)]
+    eq_(format_value(value, memo=memo),
+        u'[1,\n True,\n 1.0,\n 0.0,\n -0.0,\n [1],\n [True]]')
+    # only items of tuples were found
+    eq_(memo.stats()['hits'], 2)
+
+
+def test_memo_evicts_least_recently_used_values():
+    memo = Memo(maxsize=2)
+    format_value([1, 2, 1, 3], memo=memo)
+
+    stats = memo.stats()
+    eq_(stats['size'], 2)
+    eq_(stats['hits'], 1)
+    eq_(stats['evictions'], 1)
+
+    # 2 was evicted, 1 and 3 are still there
+    format_value([1, 3], memo=memo)
+    eq_(memo.stats()['hits'], 3)
+    format_value(2, memo=memo)
+    eq_(memo.stats()['misses'], 4)
+
+
+def test_registered_formatter_is_used_for_subclasses():
+    class Money(object):
+        def __init__(self, amount):
+            self.amount = amount
+
+    class Dollars(Money):
+        pass
+
+    # lookup result for Dollars is cached here
+    eq_(format_value([Dollars(1)]).startswith(u'[<'), True)
+
+    @register_formatter(Money)
+    def format_money(value):
+        return u'${0}'.format(value.amount)
+
+    eq_(format_value([Money(10), Dollars(5)]), u'[$10, $5]')
+
+
+def test_registered_formatter_replaces_repr_of_builtin_subclass():
+    class Id(int):
+        pass
+
+    register_formatter(Id, lambda value: u'#{0}'.format(int(value)))
+
+    eq_(format_value({u'id': Id(3), u'count': 3}),
+        u"{u'count': 3, u'id': #3}")
+
+
+def test_instrumentation_collects_stats_of_classes_and_fields():
+    class Child(object):
+        def __init__(self):
+            self.value = 1
+
+        __repr__ = make_repr()
+
+    class Parent(object):
+        def __init__(self):
+            self.child = Child()
+
+        __repr__ = make_repr('child', total=lambda obj: 100)
+
+    events = []
+    stats = instrument(hook=lambda *args: events.append(args))
+    try:
+        repr(Parent())
+        repr(Parent())
+    finally:
+        stop_instrumenting()
+
+    # not collected after stop
+    repr(Parent())
+
+    snapshot = stats.snapshot()
+    parent = snapshot[Parent.__module__ + '.Parent']
+    child = snapshot[Child.__module__ + '.Child']
+
+    eq_(parent['calls'], 2)
+    eq_(parent['chars'], 2 * len(u'<Parent child=<Child value=1> total=100>'))
+    eq_(sorted(parent['fields']), ['child', 'total'])
+    eq_(parent['fields']['total']['calls'], 2)
+    eq_(parent['time'] >= child['time'], True)
+    eq_(parent['discovery'], 0.0)
+
+    eq_(child['calls'], 2)
+    eq_(child['discovery'] > 0, True)
+    eq_(sorted(child['fields']), ['value'])
+
+    # the child is reported before its parent
+    eq_([event[0].split('.')[-1] for event in events],
+        ['Child', 'Parent', 'Child', 'Parent'])
+    eq_([name for name, seconds in events[1][3]], ['child', 'total'])
+
+
+def test_instrumentation_collects_stats_of_streamed_and_table_output():
+    class Point(object):
+        def __init__(self, x):
+            self.x = x
+
+        __repr__ = make_repr('x')
+
+    name = Point.__module__ + '.Point'
+    points = [Point(1), Point(22)]
+
+    # rows of the table are counted as output of objects
+    eq_(format_value(points, table=True), u'[Point: x\n        1\n        22]')
+
+    for output, chars in (
+            (lambda: u''.join(iter_repr(points, chunk_size=1)),
+             len(u'<Point x=1><Point x=22>')),
+            (lambda: format_value(points, table=True), 3)):
+        stats = instrument()
+        try:
+            output()
+        finally:
+            stop_instrumenting()
+
+        point = stats.snapshot()[name]
+        eq_(point['calls'], 2)
+        eq_(point['chars'], chars)
+        eq_(sorted(point['fields']), ['x'])
+
+
+def test_shared_objects_are_shown_once_with_references():
+    class Vendor(object):
+        def __init__(self):
+            self.name = u'ACME'
+
+        __repr__ = make_repr()
+
+    class Line(object):
+        def __init__(self, order, vendor):
+            self.order = order
+            self.vendor = vendor
+
+        __repr__ = make_repr('vendor', 'order')
+
+    class Order(object):
+        def __init__(self):
+            vendor = Vendor()
+            self.lines = [Line(self, vendor), Line(self, vendor)]
+
+        __repr__ = make_repr('lines', references=True)
+
+    order = Order()
+    expected = u"""
+<Order #1 lines=[<Line #2 vendor=<Vendor #3 name=u'ACME'>
+                          order=<Order #1>>,
+                 <Line #4 vendor=<Vendor #3>
+                          order=<Order #1>>]>
+"""[1:-1]
+    eq_(repr(order), expected)
+    eq_(u''.join(iter_repr(order, chunk_size=1)), expected)
+    eq_(format_value(order), expected)
+
+    # back-links from nested objects are references too
+    nested = u'[' + expected.replace(u'\n', u'\n ') + u']'
+    eq_(format_value([order]), nested)
+    eq_(u''.join(iter_repr([order], chunk_size=1)), nested)
+
+    # without references vendor is shown in full each time
+    eq_(format_value(order.lines).count(u'ACME'), 2)
+
+
+def test_references_make_diamond_graphs_linear():
+    class Node(object):
+        def __init__(self, child):
+            self.left = child
+            self.right = child
+
+        __repr__ = make_repr('left', 'right')
+
+    node = None
+    for idx in range(100):
+        node = Node(node)
+
+    result = format_value(node, references=True)
+    # each node is shown once and once as a reference,
+    # except the root one
+    eq_(result.count(u'<Node #'), 199)
+    eq_(result.count(u'<Node #100>'), 1)
+
+
+def test_dict_items_can_be_ordered_by_keys_or_kept_in_insertion_order():
+    value = {}
+    value[10] = u'a'
+    value[9] = u'b'
+    value[2] = u'c'
+
+    # by default keys are sorted as strings
+    eq_(format_value(value, max_items=2),
+        u"{10: u'a',\n 2: u'c',\n ...(1 more)}")
+    eq_(format_value(value, max_items=2, dict_order='keys'),
+        u"{2: u'c',\n 9: u'b',\n ...(1 more)}")
+    eq_(format_value(value, max_items=2, dict_order='insertion'),
+        u"{10: u'a',\n 9: u'b',\n ...(1 more)}")
+
+    # keys which can't be compared are sorted by representations
+    eq_(format_value({1: 2, u'a': 3}, dict_order='keys'),
+        u"{1: 2, u'a': 3}")
+
+
+def test_limited_dict_shows_the_first_keys_of_the_sorted_order():
+    value = {5: u'int', (1, 2): u'tuple', u'a': 1, 10: None, u'b\nc': 2}
+    expected = u"""
+{10: None,
+ 5: u'int',
+ [1, 2]: u'tuple',
+ u'a': 1,
+ u'b
+ c': 2}
+"""[1:-1]
+    eq_(format_value(value), expected)
+    eq_(format_value(value, max_items=2),
+        u"{10: None,\n 5: u'int',\n ...(3 more)}")
+    eq_(format_value(value, max_chars=30), u"""
+{10: None,
+ 5: u'int',
+ [1, 2]: u'tuple',
+ ...(2 more)}
+"""[1:-1])
+
+    value = dict((u'k{0}'.format(idx), idx) for idx in range(10000))
+    eq_(format_value(value, max_items=3),
+        u"{u'k0': 0,\n u'k1': 1,\n u'k10': 10,\n ...(9997 more)}")
+    eq_(format_value(value, max_chars=20),
+        u"{u'k0': 0,\n u'k1': 1,\n u'k10': 10,\n ...(9997 more)}")
+
+
+def test_unknown_dict_order_is_an_error():
+    try:
+        format_value({}, dict_order='values')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('ValueError was not raised')
+
+
+def test_sets_deques_and_views_are_laid_out_like_lists():
+    value = OrderedDict([(u'b', set([1])),
+                         (u'a', deque([frozenset([2])], maxlen=5))])
+    eq_(format_value(value), u"""
+OrderedDict({u'b': {1},
+             u'a': deque([frozenset({2})], maxlen=5)})
+"""[1:-1])
+
+    eq_(format_value([set(), OrderedDict()]), u'[set(), OrderedDict()]')
+    eq_(format_value({1: u'a'}.values()), u"dict_values([u'a'])")
+
+
+def test_only_shown_items_are_taken():
+    class Items(deque):
+        taken = 0
+
+        def __iter__(self):
+            for item in deque.__iter__(self):
+                Items.taken += 1
+                yield item
+
+    eq_(format_value(Items(range(1000)), max_items=3),
+        u'Items([0, 1, 2, ...(997 more)])')
+    eq_(Items.taken, 3)
+
+
+def test_iterators_are_consumed_only_if_allowed():
+    numbers = (idx * 10 for idx in range(10))
+    eq_(format_value(numbers).startswith(u'<generator object'), True)
+    eq_(format_value(numbers, max_items=2, consume_iterators=True),
+        u'<generator [0, 10, ...]>')
+
+    # one more item was taken to find out if there are more
+    eq_(list(numbers), [30, 40, 50, 60, 70, 80, 90])
+
+
+def test_groups_are_shown_in_a_row_when_they_fit_into_width():
+    class Point(object):
+        def __init__(self, x, y):
+            self.x = x
+            self.y = y
+
+        __repr__ = make_repr()
+
+    value = {u'points': [Point(1, 2), Point(3, 4)], u'name': u'path'}
+
+    eq_(format_value(value, width=80),
+        u"{u'name': u'path', u'points': [<Point x=1 y=2>, <Point x=3 y=4>]}")
+    eq_(format_value(value, width=40), u"""
+{u'name': u'path',
+ u'points': [<Point x=1 y=2>,
+             <Point x=3 y=4>]}
+"""[1:-1])
+
+    # closing brackets should fit too
+    eq_(format_value(value, width=len(u"[<Point x=1 y=2>, <Point x=3 y=4>]") +
+                     len(u" u'points': ")),
+        format_value(value, width=40))
+
+    for width in (10, 40, 80):
+        eq_(u''.join(iter_repr(value, chunk_size=3, width=width)),
+            format_value(value, width=width))
+
+
+def test_closing_brackets_of_last_items_fit_into_width():
+    for value, width in (([[0, [None, 7777777]], 5], 18),
+                         ([[[0], [[None, 7777777]]], 5], 20)):
+        lines = format_value(value, width=width).split(u'\n')
+        eq_([line for line in lines if len(line) > width], [])
+
+    eq_(format_value([[0, [None, 7777777]], 5], width=18), u"""
+[[0,
+  [None,
+   7777777]],
+ 5]
+"""[1:-1])
+
+
+def test_streamed_closing_brackets_of_last_items_fit_into_width():
+    class Obj(object):
+        def __init__(self):
+            self.b = [9276267585708495811606, 609551189428414408,
+                      0.7476835625859415]
+
+        __repr__ = make_repr()
+
+    values = [
+        {u'a': [u'x' * 20, Obj()]},
+        [[0, [None, 7777777]], 5],
+        ([[[0], [[None, 7777777]]], 5], {u'k': [1, (2, [3, 4])]}),
+    ]
+    for value in values:
+        for width in (18, 20, 40, 60, 80):
+            text = format_value(value, width=width)
+            eq_(u''.join(iter_repr(value, width=width, chunk_size=5)), text)
+            eq_(format_bytes(value, width=width), text.encode('utf-8'))
+
+
+def test_width_can_be_given_to_make_repr():
+    class Wide(object):
+        def __init__(self):
+            self.items = list(range(10))
+
+        __repr__ = make_repr(width=100)
+
+    eq_(repr(Wide()), u'<Wide items=[0, 1, 2, 3, 4, 5, 6, 7, 8, 9]>')
+    eq_(format_value(Wide()), repr(Wide()))
+
+
+def test_collections_are_formatted_after_formatter_is_replaced():
+    class Ordered(OrderedDict):
+        pass
+
+    try:
+        register_formatter(deque, lambda value: u'<deque>')
+        eq_(format_value([deque([1]), Ordered(a=1)]),
+            u"[<deque>,\n Ordered({u'a': 1})]")
+    finally:
+        from magic_repr.containers import describe_deque
+        registry.register(deque, describe_deque)
+
+
+def test_format_many():
+    class TestMe(object):
+        def __init__(self, foo):
+            self.foo = foo
+
+        __repr__ = make_repr(max_items=2)
+
+    values = [TestMe([1, 2, 3]), 1, [TestMe(2)]] * 5
+
+    eq_(format_many(values), [repr(value) for value in values])
+    eq_(format_many(values, max_items=1),
+        [format_value(value, max_items=1) for value in values])
+    # each value gets it's own budget
+    eq_(format_many([u'abc', u'def'], max_chars=6), [u"u'abc'", u"u'def'"])
+
+    stream = io.BytesIO()
+    format_many(values[:2], stream)
+    eq_(stream.getvalue(), b'<TestMe foo=[1, 2, ...(1 more)]>\n1\n')
+
+
+def test_format_many_reuses_class_plans():
+    calls = []
+
+    def get_kind(obj):
+        calls.append(obj)
+        return obj.__class__.__name__
+
+    class Point(object):
+        def __init__(self, x, y):
+            self.x = x
+            self.y = y
+
+        __repr__ = make_repr('x', 'y', kind=get_kind)
+
+    class Point3D(Point):
+        pass
+
+    class Wide(object):
+        def __init__(self, x):
+            self.x = x
+
+        __repr__ = make_repr('x', width=10)
+
+    values = [Point(1, 2), Point3D(3, u'abc'), Point([1, 2], {u'a': 1}),
+              Wide(u'a' * 20), Point(4, 5), Point(u'a' * 30, u'b' * 30)]
+    expected = [repr(value) for value in values]
+    del calls[:]
+
+    eq_(format_many(values), expected)
+    # getters are called once, even when a value is not a leaf
+    eq_(len(calls), len(values) - 1)
+    eq_(format_many(values, max_items=1),
+        [format_value(value, max_items=1) for value in values])
+    eq_(format_many(values, width=30),
+        [format_value(value, width=30) for value in values])
+
+    # layout is compiled once for all objects
+    describe = Point.__repr__.magic_repr_describe
+    compiled = describe.batch_compiled
+    eq_(compiled is None, False)
+    format_many(values)
+    eq_(describe.batch_compiled is compiled, True)
+    # repr is not affected
+    eq_(describe.compiled, None)
+
+
+def test_format_many_with_workers():
+    values = [{u'id': idx, u'tags': [idx] * idx} for idx in range(30)]
+    expected = [format_value(value) for value in values]
+
+    eq_(format_many(values, workers=3, batch_size=4), expected)
+    eq_(format_many(iter(values), workers=2, processes=True, batch_size=7),
+        expected)
+
+
+def test_table_of_objects():
+    class Point(object):
+        def __init__(self, x, y, label=None):
+            self.x = x
+            self.y = y
+            self.label = label
+
+        __repr__ = make_repr('x', 'y', 'label')
+
+    points = [Point(1, 2, u'a'), Point(10, [1, 2]), Point(3, 4, u'b')]
+
+    eq_(format_value(points, table=True), u"""
+[Point: x   y       label
+        1   2       u'a'
+        10  [1, 2]  None
+        3   4       u'b']
+"""[1:-1])
+
+    eq_(format_value(points, table=True, max_items=1), u"""
+[Point: x  y  label
+        1  2  u'a'
+        ...(2 more)]
+"""[1:-1])
+
+    eq_(u''.join(iter_repr(points, chunk_size=5, table=True)),
+        format_value(points, table=True))
+
+
+def test_table_takes_fields_of_shown_rows_only():
+    calls = []
+
+    class Point(object):
+        def __init__(self, x):
+            self.x = x
+
+        @property
+        def y(self):
+            calls.append(self.x)
+            return self.x
+
+        __repr__ = make_repr('x', 'y')
+
+    points = [Point(idx) for idx in range(10000)]
+    result = format_value(points, table=True, max_chars=20)
+    eq_(result, u"""
+[Point: x  y
+        0  0
+        1  1
+        2  2
+        3  3
+        4  4
+        5  5
+        6  6
+        7  7
+        8  8
+        9  9
+        ...(9990 more)]
+"""[1:-1])
+    eq_(calls, list(range(10)))
+
+
+def test_table_falls_back_to_usual_layout():
+    class Point(object):
+        def __init__(self, x):
+            self.x = x
+
+        __repr__ = make_repr('x')
+
+    class Other(Point):
+        pass
+
+    # objects of different classes
+    eq_(format_value([Point(1), Other(2)], table=True),
+        format_value([Point(1), Other(2)]))
+
+    # multiline values
+    multiline = [Point(1), Point([u'a' * 10, u'b' * 10])]
+    eq_(format_value(multiline, table=True), format_value(multiline))
+
+    # table is on for the class's own fields
+    class Polygon(object):
+        def __init__(self):
+            self.points = [Point(1), Point(2)]
+
+        __repr__ = make_repr(table=True)
+
+    eq_(repr(Polygon()), u"""
+<Polygon points=[Point: x
+                        1
+                        2]>
+"""[1:-1])
+
+
+def test_format_bytes():
+    value = {u'имя': [b'bytes', 1] * 3000}
+    expected = format_value(value).encode('utf-8')
+
+    eq_(format_bytes(value), expected)
+    # text is encoded piece by piece, in chunks of any size
+    eq_(format_bytes(value, chunk_size=7), expected)
+    eq_(format_bytes([1]), b'[1]')
+    eq_(format_bytes(value, encoding='utf-16'),
+        format_value(value).encode('utf-16'))
+
+    buffer = bytearray(b'>')
+    format_bytes(value, buffer=buffer, max_items=2)
+    eq_(buffer, b'>' + format_value(value, max_items=2).encode('utf-8'))
+
+    stream = io.BytesIO()
+    format_bytes(value, buffer=stream, width=100)
+    eq_(stream.getvalue(), format_value(value, width=100).encode('utf-8'))
+
+
+def test_arepr():
+    import asyncio
+
+    main_thread = threading.current_thread()
+    threads = []
+
+    class TestMe(object):
+        def __init__(self, items):
+            self.items = items
+
+        __repr__ = make_repr(
+            thread=lambda self: threads.append(threading.current_thread()))
+
+    small = TestMe([1, 2])
+    big = TestMe([TestMe(list(range(10)))] * 200)
+
+    async def format_both():
+        return await asyncio.gather(arepr(small), arepr(big, max_items=3))
+
+    eq_(asyncio.run(format_both()),
+        [repr(small), format_value(big, max_items=3)])
+
+    # the small object is formatted in the event loop's thread,
+    # the big one with it's nested objects in another one
+    eq_(threads[0], main_thread)
+    assert threads[1] is not main_thread
+
+
+def test_deadline():
+    import time
+
+    class Slow(object):
+        @property
+        def slow(self):
+            time.sleep(0.02)
+            return 1
+
+        __repr__ = make_repr('slow', other=lambda self: 2)
+
+    timeouts.reset()
+    eq_(format_value([1, 2, 3], deadline_ms=0), u'[...<timeout>]')
+    eq_(format_value([[1, 2], 3], deadline_ms=0), u'[...<timeout>]')
+    eq_(timeouts.value, 2)
+
+    # fields are checked too, and only one marker is shown
+    eq_(format_value([Slow(), 2], deadline_ms=10),
+        u'[<Slow slow=1 ...<timeout>>]')
+    eq_(timeouts.value, 3)
+
+    eq_(format_value([Slow(), 2], deadline_ms=1000),
+        u'[<Slow slow=1 other=2>,\n 2]')
+    eq_(timeouts.value, 3)
+
+
+def test_deadline_stops_sorting_of_dict_keys():
+    import time
+
+    value = dict((u'k{0}'.format(idx), idx) for idx in range(200000))
+    started = time.time()
+    result = format_value(value, deadline_ms=5)
+    # keys are not laid out once the deadline is reached
+    assert time.time() - started < 0.5
+    eq_(result.endswith(u'...<timeout>}'), True)
+
+
+def test_deadline_can_be_given_to_make_repr():
+    class TestMe(object):
+        def __init__(self):
+            self.items = list(range(100))
+
+        __repr__ = make_repr(deadline_ms=0)
+
+    eq_(repr(TestMe()), u'<TestMe ...<timeout>>')
+
+
+def test_deadline_of_object_does_not_apply_to_siblings():
+    import time
+
+    class Quick(object):
+        x = 1
+        __repr__ = make_repr('x', deadline_ms=1)
+
+    class Slow(object):
+        @property
+        def y(self):
+            time.sleep(0.01)
+            return 2
+
+        __repr__ = make_repr('y')
+
+    timeouts.reset()
+    value = [Quick(), Slow(), Slow(), u'after']
+    expected = u"[<Quick x=1>,\n <Slow y=2>,\n <Slow y=2>,\n u'after']"
+    eq_(format_value(value, max_items=100), expected)
+    eq_(u''.join(iter_repr(value, max_items=100)), expected)
+    eq_(format_value(value, table=True), expected)
+    eq_(timeouts.value, 0)
+
+
+def test_automatic_builder_does_not_call_properties():
+    calls = []
+
+    class TestMe(object):
+        __slots__ = ('foo', '__dict__')
+        kind = u'test'
+
+        def __init__(self):
+            self.foo = 1
+            self.bar = 2
+
+        @property
+        def loaded(self):
+            calls.append(u'loaded')
+            return 3
+
+        @property
+        def bar(self):
+            calls.append(u'bar')
+            return 4
+
+        @bar.setter
+        def bar(self, value):
+            self.__dict__['bar'] = value
+
+        __repr__ = make_repr()
+
+    # value of bar is taken from the instance's __dict__
+    eq_(repr(TestMe()), u"<TestMe bar=2\n        foo=1\n        kind=u'test'>")
+    eq_(calls, [])
+
+    TestMe.__repr__ = make_repr(properties='loaded')
+    eq_(repr(TestMe()),
+        u"<TestMe bar=2\n        foo=1\n        kind=u'test'\n        loaded=3>")
+    eq_(calls, [u'loaded'])
+
+    TestMe.__repr__ = make_repr(properties=True)
+    eq_(repr(TestMe()),
+        u"<TestMe bar=4\n        foo=1\n        kind=u'test'\n        loaded=3>")
+
+    TestMe.__repr__ = make_repr(properties=False)
+    eq_(repr(TestMe()), u"<TestMe bar=2\n        foo=1\n        kind=u'test'>")
+
+    try:
+        make_repr(properties=1)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('ValueError was not raised')
+
+
+def test_cached_repr_is_rendered_again_after_changes():
+    import gc
+
+    class TestMe(object):
+        def __init__(self):
+            self.foo = 1
+            self.bar = [1]
+            self.other = 2
+
+        __repr__ = make_repr('foo', 'bar', cache=True)
+
+    cache = TestMe.__repr__.magic_repr_cache
+    instance = TestMe()
+    eq_(repr(instance), u'<TestMe foo=1 bar=[1]>')
+    eq_(repr(instance), u'<TestMe foo=1 bar=[1]>')
+    eq_(cache.stats(), dict(size=1, hits=1, misses=1))
+
+    # changes of other attributes and of values are not tracked
+    instance.other = 3
+    instance.bar.append(2)
+    eq_(repr(instance), u'<TestMe foo=1 bar=[1]>')
+
+    instance.foo = 2
+    eq_(repr(instance), u'<TestMe foo=2 bar=[1, 2]>')
+    del instance.foo
+    instance.foo = 3
+    eq_(repr(instance), u'<TestMe foo=3 bar=[1, 2]>')
+
+    # inside of other values, objects are formatted as usual
+    eq_(format_value([instance], max_items=1),
+        u'[<TestMe foo=3\n         bar=[1, ...(1 more)]>]')
+
+    # the cache doesn't keep objects alive
+    del instance
+    gc.collect()
+    eq_(len(cache), 0)
+
+
+def test_objects_without_weak_references_are_not_cached():
+    class TestMe(object):
+        __slots__ = ('foo',)
+
+        def __init__(self):
+            self.foo = 1
+
+        __repr__ = make_repr(cache=True)
+
+    instance = TestMe()
+    eq_(repr(instance), u'<TestMe foo=1>')
+    instance.foo = 2
+    eq_(repr(instance), u'<TestMe foo=2>')
+    eq_(len(TestMe.__repr__.magic_repr_cache), 0)
+    # assignments are not slowed down for nothing
+    eq_(getattr(TestMe.__setattr__, 'magic_repr_cache', None), None)